@@ -0,0 +1,38 @@
+"""
+State names shared by the Wikipedia flag scripts.
+
+The scripts reject images of state flags that show up in municipality
+articles. They used to keep their own copies of the UF table and of the
+state-flag name lists derived from it, which had started to drift apart.
+
+Usage (from a script in this directory):
+  from brazil_states import UF_NAMES, STATE_FLAG_NAMES, STATE_SLUGS
+  uf_name = UF_NAMES.get(uf, uf)
+"""
+
+import unicodedata
+
+UF_NAMES = {
+    "RO": "Rondônia", "AC": "Acre", "AM": "Amazonas", "RR": "Roraima",
+    "PA": "Pará", "AP": "Amapá", "TO": "Tocantins", "MA": "Maranhão",
+    "PI": "Piauí", "CE": "Ceará", "RN": "Rio Grande do Norte",
+    "PB": "Paraíba", "PE": "Pernambuco", "AL": "Alagoas", "SE": "Sergipe",
+    "BA": "Bahia", "MG": "Minas Gerais", "ES": "Espírito Santo",
+    "RJ": "Rio de Janeiro", "SP": "São Paulo", "PR": "Paraná",
+    "SC": "Santa Catarina", "RS": "Rio Grande do Sul",
+    "MS": "Mato Grosso do Sul", "MT": "Mato Grosso", "GO": "Goiás",
+    "DF": "Distrito Federal",
+}
+
+# Lowercased titles of state flag images, with every preposition form
+STATE_FLAG_NAMES = frozenset(
+    f"{prefix} {name.lower()}"
+    for name in UF_NAMES.values()
+    for prefix in ("bandeira de", "bandeira do", "bandeira da", "flag of")
+)
+
+# State names as they appear in slugged filenames ("mato-grosso-do-sul")
+STATE_SLUGS = frozenset(
+    unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii").lower().replace(" ", "-")
+    for name in UF_NAMES.values()
+)
@@ -12,17 +12,58 @@ Usage:
 """
 
 import json
-from collections import defaultdict
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 
+from municipios_db import save_json, save_municipios
+
 ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT / "data"
 DIST_DIR = ROOT / "dist"
 DATABASE_DIR = ROOT / "database"
+DIST_ROOT = os.fspath(DIST_DIR)  # plain str for the os.* calls in the scan
 MUNICIPIOS_JSON = DATA_DIR / "municipios.json"
 
+ICON_STYLES = ["full", "rounded", "circle", "square-rounded"]
+ICON_FORMATS = ["svg", "png-200", "png-800"]
+SCAN_WORKERS = 32  # dist/ listing is I/O bound; threads overlap the syscalls
+
+
+def _list_icon_dir(rel_dir):
+    """List the filenames in one dist/ leaf directory."""
+    try:
+        with os.scandir(os.path.join(DIST_ROOT, rel_dir)) as it:
+            return rel_dir, {entry.name for entry in it if entry.is_file()}
+    except FileNotFoundError:
+        return rel_dir, set()
+
+
+def build_icon_index():
+    """List every dist/{style}/{format}/{uf} directory once.
+
+    Returns a dict mapping "{style}/{format}/{uf}" to the set of filenames
+    found in that directory. The leaf directories are listed concurrently
+    since the scan is bound by filesystem latency, not CPU.
+    """
+    leaf_dirs = []
+    for style_name in ICON_STYLES:
+        for fmt in ICON_FORMATS:
+            fmt_dir = os.path.join(DIST_ROOT, style_name, fmt)
+            if not os.path.isdir(fmt_dir):
+                continue
+            with os.scandir(fmt_dir) as it:
+                leaf_dirs.extend(
+                    f"{style_name}/{fmt}/{entry.name}" for entry in it if entry.is_dir()
+                )
+
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        return dict(executor.map(_list_icon_dir, leaf_dirs))
 
-def check_generated_files(ibge_code, slug, uf):
+
+def check_generated_files(ibge_code, slug, uf, icon_index):
     """Check which generated icon files exist for a municipality."""
     styles = {
         "full": f"{ibge_code}-{slug}-full",
@@ -33,20 +74,19 @@ def check_generated_files(ibge_code, slug, uf):
 
     paths = {}
     has_icons = False
+    empty = frozenset()
 
     for style_name, basename in styles.items():
-        svg_path = DIST_DIR / style_name / "svg" / uf / f"{basename}.svg"
-        if svg_path.exists():
+        svg_dir = f"{style_name}/svg/{uf}"
+        if f"{basename}.svg" in icon_index.get(svg_dir, empty):
             has_icons = True
-            paths[f"{style_name}_svg"] = f"{style_name}/svg/{uf}/{basename}.svg"
+            paths[f"{style_name}_svg"] = f"{svg_dir}/{basename}.svg"
 
         for size_label in ["png-200", "png-800"]:
-            png_path = DIST_DIR / style_name / size_label / uf / f"{basename}.png"
-            if png_path.exists():
+            png_dir = f"{style_name}/{size_label}/{uf}"
+            if f"{basename}.png" in icon_index.get(png_dir, empty):
                 has_icons = True
-                paths[f"{style_name}_{size_label}"] = (
-                    f"{style_name}/{size_label}/{uf}/{basename}.png"
-                )
+                paths[f"{style_name}_{size_label}"] = f"{png_dir}/{basename}.png"
 
     return has_icons, paths
 
@@ -59,17 +99,16 @@ def build_database():
 
     print(f"Loaded {len(municipios_raw)} municipalities")
     print(f"Checking generated icons in {DIST_DIR}...")
+    icon_index = build_icon_index()
 
     DATABASE_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Build enriched municipality list
+    # Build enriched municipality list. Walking the source in ibge_code order
+    # means municipios and every by_uf list come out already sorted.
+    municipios_raw.sort(key=itemgetter("ibge_code"))
     municipios = []
     by_uf = defaultdict(list)
-    stats_by_uf = defaultdict(lambda: {"total": 0, "with_flag": 0, "with_icons": 0})
-    stats_by_region = defaultdict(lambda: {"total": 0, "with_flag": 0, "with_icons": 0})
-
-    total_with_flag = 0
-    total_with_icons = 0
+    group_keys = []
 
     for mun in municipios_raw:
         ibge_code = mun["ibge_code"]
@@ -78,7 +117,7 @@ def build_database():
         region = mun.get("region_name", mun.get("region", ""))
 
         has_raw_flag = bool(mun.get("flag_local"))
-        has_icons, icon_paths = check_generated_files(ibge_code, slug, uf)
+        has_icons, icon_paths = check_generated_files(ibge_code, slug, uf, icon_index)
 
         entry = {
             "ibge_code": ibge_code,
@@ -96,30 +135,28 @@ def build_database():
         if has_icons:
             entry["icons"] = icon_paths
 
-        if has_raw_flag:
-            total_with_flag += 1
-        if has_icons:
-            total_with_icons += 1
-
         municipios.append(entry)
         by_uf[uf].append(entry)
+        group_keys.append((uf, region, has_raw_flag, has_icons))
 
-        stats_by_uf[uf]["total"] += 1
-        if has_raw_flag:
-            stats_by_uf[uf]["with_flag"] += 1
-        if has_icons:
-            stats_by_uf[uf]["with_icons"] += 1
+    # Aggregate counts per (UF, region, flag, icons) group in one C-level
+    # pass, then fold the handful of groups into per-UF and per-region stats
+    stats_by_uf = defaultdict(lambda: {"total": 0, "with_flag": 0, "with_icons": 0})
+    stats_by_region = defaultdict(lambda: {"total": 0, "with_flag": 0, "with_icons": 0})
+    total_with_flag = 0
+    total_with_icons = 0
 
-        stats_by_region[region]["total"] += 1
+    for (uf, region, has_raw_flag, has_icons), count in Counter(group_keys).items():
+        for s in (stats_by_uf[uf], stats_by_region[region]):
+            s["total"] += count
+            if has_raw_flag:
+                s["with_flag"] += count
+            if has_icons:
+                s["with_icons"] += count
         if has_raw_flag:
-            stats_by_region[region]["with_flag"] += 1
+            total_with_flag += count
         if has_icons:
-            stats_by_region[region]["with_icons"] += 1
-
-    # Sort municipalities by ibge_code
-    municipios.sort(key=lambda m: m["ibge_code"])
-    for uf_key in by_uf:
-        by_uf[uf_key].sort(key=lambda m: m["ibge_code"])
+            total_with_icons += count
 
     # Build stats
     total = len(municipios_raw)
@@ -173,18 +210,15 @@ def build_database():
 
     # Write database files
     mun_path = DATABASE_DIR / "municipios.json"
-    with open(mun_path, "w", encoding="utf-8") as f:
-        json.dump(municipios, f, ensure_ascii=False, indent=2)
+    save_municipios(mun_path, municipios)
     print(f"  {mun_path} ({len(municipios)} entries)")
 
     by_uf_path = DATABASE_DIR / "municipios-by-uf.json"
-    with open(by_uf_path, "w", encoding="utf-8") as f:
-        json.dump(dict(by_uf), f, ensure_ascii=False, indent=2)
+    save_json(by_uf_path, dict(by_uf))
     print(f"  {by_uf_path} ({len(by_uf)} states)")
 
     stats_path = DATABASE_DIR / "stats.json"
-    with open(stats_path, "w", encoding="utf-8") as f:
-        json.dump(stats, f, ensure_ascii=False, indent=2)
+    save_json(stats_path, stats)
     print(f"  {stats_path}")
 
     # Print summary
@@ -20,6 +20,8 @@ import re
 from pathlib import Path
 from collections import defaultdict
 
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
 UF_CODES = {
@@ -48,14 +50,17 @@ REGION_MAP = {
     "S": "Sul", "CO": "Centro-Oeste",
 }
 
+SLUG_SEPARATORS_RE = re.compile(r"[^a-z0-9]+")
+
 
 def slugify(text: str) -> str:
     """Convert text to URL/filename-safe slug."""
-    # Normalize unicode (remove accents)
-    text = unicodedata.normalize("NFKD", text)
-    text = text.encode("ascii", "ignore").decode("ascii")
+    # Normalize unicode (remove accents); plain ASCII names need no work
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = text.encode("ascii", "ignore").decode("ascii")
     # Lowercase and replace non-alphanumeric with hyphens
-    text = re.sub(r"[^a-z0-9]+", "-", text.lower())
+    text = SLUG_SEPARATORS_RE.sub("-", text.lower())
     text = text.strip("-")
     return text
 
@@ -65,9 +70,9 @@ def build_wikipedia_slug(name: str) -> str:
     return name.replace(" ", "_")
 
 
-def build_wikidata_search_name(name: str, uf: str) -> str:
+def build_wikidata_search_name(name: str, state_name: str) -> str:
     """Build search string for Wikidata queries."""
-    return f"{name} ({UF_NAMES.get(uf, uf)})"
+    return f"{name} ({state_name})"
 
 
 def main():
@@ -81,6 +86,9 @@ def main():
     # Parse into clean structure
     municipios = []
     by_uf = defaultdict(list)
+    # UF and region fields are the same for every municipality of a state,
+    # so resolve them once per UF: sigla -> (nome, regiao sigla, regiao nome, search name)
+    uf_cache = {}
 
     for item in raw_data:
         # Extract UF info from microrregiao or regiao-imediata (fallback for newer municipalities)
@@ -100,9 +108,15 @@ def main():
             continue
 
         uf_sigla = uf_data["sigla"]
-        uf_nome = uf_data["nome"]
-        regiao_sigla = uf_data["regiao"]["sigla"]
-        regiao_nome = uf_data["regiao"]["nome"]
+        uf_info = uf_cache.get(uf_sigla)
+        if uf_info is None:
+            uf_info = uf_cache[uf_sigla] = (
+                uf_data["nome"],
+                uf_data["regiao"]["sigla"],
+                uf_data["regiao"]["nome"],
+                UF_NAMES.get(uf_sigla, uf_sigla),
+            )
+        uf_nome, regiao_sigla, regiao_nome, search_state = uf_info
 
         municipio = {
             "ibge_code": item["id"],
@@ -121,7 +135,7 @@ def main():
             "flag_file": None,  # Local filename in dist/
             # Wikipedia/Wikidata references
             "wikipedia_slug": build_wikipedia_slug(item["nome"]),
-            "wikidata_search": build_wikidata_search_name(item["nome"], uf_sigla),
+            "wikidata_search": build_wikidata_search_name(item["nome"], search_state),
         }
 
         municipios.append(municipio)
@@ -134,14 +148,12 @@ def main():
 
     # Write full database
     out_path = DATA_DIR / "municipios.json"
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(municipios, f, ensure_ascii=False, indent=2)
+    save_municipios(out_path, municipios)
     print(f"Wrote {len(municipios)} municipalities to {out_path}")
 
     # Write grouped by UF
     by_uf_path = DATA_DIR / "municipios-by-uf.json"
-    with open(by_uf_path, "w", encoding="utf-8") as f:
-        json.dump(dict(by_uf), f, ensure_ascii=False, indent=2)
+    save_json(by_uf_path, dict(by_uf))
     print(f"Wrote {len(by_uf)} states to {by_uf_path}")
 
     # Write CSV
@@ -183,8 +195,7 @@ def main():
     }
 
     stats_path = DATA_DIR / "stats.json"
-    with open(stats_path, "w", encoding="utf-8") as f:
-        json.dump(stats, f, ensure_ascii=False, indent=2)
+    save_json(stats_path, stats)
     print(f"Wrote stats to {stats_path}")
 
     # Print summary
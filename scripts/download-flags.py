@@ -4,8 +4,19 @@ Download all found flag images from Wikimedia Commons.
 
 Reads data/municipios.json for entries with flag_status=found,
 downloads the original files organized by UF into data/raw-flags/{UF}/.
+
+Each worker thread keeps its own keep-alive connection to
+upload.wikimedia.org, so --workers is also the number of open connections.
+
+Usage:
+  python3 scripts/download-flags.py [--workers N] [--refresh]
+
+--refresh re-requests flags that are already on disk with If-Modified-Since,
+so unchanged files cost a 304 instead of a full download.
 """
 
+import argparse
+import functools
 import json
 import os
 import time
@@ -14,9 +25,16 @@ import urllib.request
 import urllib.parse
 import urllib.error
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 from tqdm import tqdm
 
+import http_session
+from downloader import (
+    backoff_delay, download_many, if_modified_since, pause_all, retry_after,
+    save_response, wait_if_paused,
+)
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
@@ -27,7 +45,7 @@ RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 MAX_WORKERS = 3  # Reduced to avoid 429 rate limiting
 RETRY_COUNT = 5
-RETRY_DELAY = 5  # seconds between retries
+RETRY_DELAY = 5  # base for exponential backoff between retries
 REQUEST_TIMEOUT = 30  # seconds
 
 
@@ -45,35 +63,73 @@ def get_file_extension(filename: str) -> str:
     return Path(filename).suffix.lower()
 
 
-def download_file(url: str, dest: Path, retries: int = RETRY_COUNT) -> tuple:
-    """Download a file with retries. Returns (success, dest, error_msg)."""
+def download_file(url: str, dest: Path, retries: int = RETRY_COUNT, refresh: bool = False) -> tuple:
+    """Download a file with retries. Returns (success, dest, size or error_msg).
+
+    With refresh, an existing dest is revalidated with If-Modified-Since;
+    size is None when the server answers 304 Not Modified.
+    """
     for attempt in range(retries):
+        wait_if_paused()
         try:
-            req = urllib.request.Request(url, headers={
+            headers = {
                 "User-Agent": "BandeirasmunicipiosBR/1.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
-            })
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                data = response.read()
-                dest.parent.mkdir(parents=True, exist_ok=True)
-                with open(dest, "wb") as f:
-                    f.write(data)
-                return (True, dest, len(data))
+            }
+            if refresh:
+                headers.update(if_modified_since(dest))
+            req = urllib.request.Request(url, headers=headers)
+            with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                if response.status == 304:
+                    response.read()
+                    return (True, dest, None)
+                return (True, dest, save_response(response, dest))
         except urllib.error.HTTPError as e:
             if e.code == 404:
                 return (False, dest, f"404 Not Found")
-            if attempt < retries - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-            else:
+            if attempt == retries - 1:
                 return (False, dest, f"HTTP {e.code}: {e.reason}")
+            delay = retry_after(e.headers) if e.code in (429, 503) else None
+            if delay is not None:
+                # The limit is per client, so every worker has to back off
+                pause_all(delay)
+            else:
+                time.sleep(backoff_delay(attempt, RETRY_DELAY))
         except Exception as e:
             if attempt < retries - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
+                time.sleep(backoff_delay(attempt, RETRY_DELAY))
             else:
                 return (False, dest, str(e))
     return (False, dest, "Max retries exceeded")
 
 
+def scan_existing_flags() -> dict:
+    """Map UF -> {filename: size} for everything already in raw-flags/{UF}/.
+
+    One scandir pass replaces an exists() + stat() pair per municipality.
+    """
+    existing = {}
+    if not RAW_FLAGS_DIR.is_dir():
+        return existing
+    with os.scandir(RAW_FLAGS_DIR) as uf_dirs:
+        for uf_dir in uf_dirs:
+            if uf_dir.is_dir():
+                with os.scandir(uf_dir.path) as it:
+                    existing[uf_dir.name] = {e.name: e.stat().st_size for e in it if e.is_file()}
+    return existing
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Download flag images from Wikimedia Commons")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of parallel downloads (default: {MAX_WORKERS})"
+    )
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="Re-check already downloaded flags and fetch only those changed on Commons"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 WIKIMEDIA COMMONS FLAG DOWNLOADER")
     print("=" * 60)
@@ -88,93 +144,93 @@ def main():
     print(f"\n  📂 {len(to_download)} flags to download out of {len(municipios)} municipalities")
 
     # Skip already downloaded
+    existing = scan_existing_flags()
     already_done = 0
-    pending = []
+    tasks = []
     for m in to_download:
         uf = m["uf"]
         slug = m["slug"]
         ext = get_file_extension(m["flag_file"])
-        dest = RAW_FLAGS_DIR / uf / f"{m['ibge_code']}-{slug}{ext}"
-        if dest.exists() and dest.stat().st_size > 0:
+        filename = f"{m['ibge_code']}-{slug}{ext}"
+        dest = RAW_FLAGS_DIR / uf / filename
+        if existing.get(uf, {}).get(filename, 0) > 0 and not args.refresh:
             already_done += 1
         else:
-            pending.append((m, dest))
+            url = get_commons_direct_url(m["flag_file"])
+            tasks.append((m, url, dest))
 
     print(f"  ✅ Already downloaded: {already_done}")
-    print(f"  ⏳ Pending download:   {len(pending)}")
+    print(f"  ⏳ Pending download:   {len(tasks)}")
 
-    if not pending:
+    if not tasks:
         print("\n  Nothing to download!")
         return
 
-    # Prepare download tasks
-    tasks = []
-    for m, dest in pending:
-        url = get_commons_direct_url(m["flag_file"])
-        tasks.append((m, url, dest))
-
     # Download with thread pool and progress bar
     success_count = 0
+    not_modified = 0
     fail_count = 0
     total_bytes = 0
     errors = []
 
-    print(f"\n  Downloading {len(tasks)} flags with {MAX_WORKERS} workers...\n")
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_task = {}
-        for m, url, dest in tasks:
-            future = executor.submit(download_file, url, dest)
-            future_to_task[future] = (m, url, dest)
-
-        with tqdm(total=len(tasks), desc="  Downloading flags", unit="file",
-                  bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]") as pbar:
-            for future in as_completed(future_to_task):
-                m, url, dest = future_to_task[future]
-                ok, path, result = future.result()
-                if ok:
-                    success_count += 1
-                    total_bytes += result
-                else:
-                    fail_count += 1
-                    errors.append({
-                        "name": m["name"],
-                        "uf": m["uf"],
-                        "ibge_code": m["ibge_code"],
-                        "url": url,
-                        "error": result,
-                    })
-                pbar.update(1)
-                pbar.set_postfix(ok=success_count, fail=fail_count)
+    print(f"\n  Downloading {len(tasks)} flags with {args.workers} workers...\n")
+
+    with tqdm(total=len(tasks), desc="  Downloading flags", unit="file",
+              bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]") as pbar:
+        jobs = [((m, url, dest), url, dest) for m, url, dest in tasks]
+        download = functools.partial(download_file, refresh=args.refresh)
+        for (m, url, dest), (ok, path, result) in download_many(download, jobs, args.workers):
+            if ok and result is None:
+                not_modified += 1
+            elif ok:
+                success_count += 1
+                total_bytes += result
+                existing.setdefault(m["uf"], {})[dest.name] = result
+            else:
+                fail_count += 1
+                errors.append({
+                    "name": m["name"],
+                    "uf": m["uf"],
+                    "ibge_code": m["ibge_code"],
+                    "url": url,
+                    "error": result,
+                })
+            pbar.update(1)
+            pbar.set_postfix(ok=success_count, fail=fail_count)
 
     # Update database with download status
     downloaded_set = set()
     for m, url, dest in tasks:
-        if dest.exists() and dest.stat().st_size > 0:
+        if existing.get(m["uf"], {}).get(dest.name, 0) > 0:
             downloaded_set.add(m["ibge_code"])
 
+    updated = 0
     for m in municipios:
         if m["ibge_code"] in downloaded_set:
             uf = m["uf"]
             slug = m["slug"]
             ext = get_file_extension(m["flag_file"])
-            m["flag_local"] = f"raw-flags/{uf}/{m['ibge_code']}-{slug}{ext}"
+            flag_local = f"raw-flags/{uf}/{m['ibge_code']}-{slug}{ext}"
+            if m.get("flag_local") != flag_local:
+                m["flag_local"] = flag_local
+                updated += 1
 
-    with open(db_path, "w", encoding="utf-8") as f:
-        json.dump(municipios, f, ensure_ascii=False, indent=2)
+    # Refreshes and re-runs mostly find flag_local already set
+    if updated:
+        save_municipios(db_path, municipios)
 
     # Save errors
     if errors:
         errors_path = DATA_DIR / "download-errors.json"
-        with open(errors_path, "w", encoding="utf-8") as f:
-            json.dump(errors, f, ensure_ascii=False, indent=2)
+        save_json(errors_path, errors)
 
     # Count file types
-    ext_counts = {}
-    for m, dest in [(m, d) for m, d in [(m, RAW_FLAGS_DIR / m["uf"] / f"{m['ibge_code']}-{m['slug']}{get_file_extension(m['flag_file'])}")
-                                         for m in to_download] if d.exists()]:
+    # existing already reflects this run's downloads, so no need to stat
+    ext_counts = Counter()
+    for m in to_download:
         ext = get_file_extension(m["flag_file"])
-        ext_counts[ext] = ext_counts.get(ext, 0) + 1
+        if f"{m['ibge_code']}-{m['slug']}{ext}" in existing.get(m["uf"], ()):
+            ext_counts[ext] += 1
 
     # Print summary
     mb = total_bytes / (1024 * 1024)
@@ -183,11 +239,13 @@ def main():
     print("=" * 60)
     print(f"  ✅ Downloaded:      {success_count:>6} files ({mb:.1f} MB)")
     print(f"  ⏭️  Already cached:  {already_done:>6} files")
+    if args.refresh:
+        print(f"  🔁 Not modified:    {not_modified:>6} files")
     print(f"  ❌ Failed:          {fail_count:>6} files")
     print(f"  ─────────────────────────────────────")
-    print(f"  📁 Total on disk:   {success_count + already_done:>6} files")
+    print(f"  📁 Total on disk:   {success_count + already_done + not_modified:>6} files")
     print(f"\n  File types:")
-    for ext, count in sorted(ext_counts.items(), key=lambda x: -x[1]):
+    for ext, count in ext_counts.most_common():
         print(f"    {ext:8s} {count:>5}")
     if errors:
         print(f"\n  ⚠️  {len(errors)} errors saved to data/download-errors.json")
@@ -0,0 +1,223 @@
+"""
+Concurrent download runner and request pacing shared by the flag
+collection scripts.
+
+Each script keeps its own download_file(url, dest) (retry policy, sanity
+checks); download_many() only fans those calls out over a thread pool.
+Worker threads get their own keep-alive connection from http_session, so
+the number of workers is also the number of open connections per host.
+
+API calls are paced with a TokenBucket instead of fixed sleeps: it lets
+requests through at up to its configured rate, halves the rate and pauses
+on 429 responses, and climbs back while requests succeed. Crawls that hit
+many unrelated hosts use a HostPacer, which only spaces out requests that
+go to the same host.
+
+Both runners keep only a couple of tasks per worker queued, so Ctrl-C
+stops a long run after the requests already in flight instead of after
+every submitted one.
+
+Usage (from a script in this directory):
+  from downloader import download_many, map_unordered
+  for key, result in download_many(download_file, tasks, workers=3):
+      ...
+  for m, result in map_unordered(process_municipality, missing, workers=4):
+      ...
+
+  API_RATE = TokenBucket(rate=0.5)  # requests per second
+  API_RATE.acquire()                # before each request
+  API_RATE.success()                # after a good response
+  API_RATE.pause(seconds)           # on 429
+
+  PACER = HostPacer(delay=1.0)
+  PACER.wait(urlsplit(url).netloc)  # before each request
+"""
+
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import formatdate, parsedate_to_datetime
+
+CHUNK_SIZE = 64 * 1024
+
+# Monotonic time before which no worker should send another request
+_resume_at = 0.0
+_resume_lock = threading.Lock()
+
+
+def pause_all(seconds: float):
+    """Hold back every worker's next request (e.g. after a 429 Retry-After)."""
+    global _resume_at
+    with _resume_lock:
+        _resume_at = max(_resume_at, time.monotonic() + seconds)
+
+
+def wait_if_paused():
+    """Sleep until a pause set by any worker has expired."""
+    delay = _resume_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def retry_after(headers):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None."""
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 60) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Thread-safe request pacer that adapts to 429 responses.
+
+    Tokens refill at `rate` per second up to `capacity` (the allowed burst).
+    pause() stops handing out tokens for a while and halves the rate (down
+    to a quarter of the configured rate); each success() adds back a quarter
+    of the configured rate until it is reached again.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.max_rate = self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now > self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                if self.tokens >= 1 and now >= self.updated:
+                    self.tokens -= 1
+                    return
+                # Either paused (updated is in the future) or out of tokens
+                wait = max(self.updated - now, 0) + (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Back off after a 429: no tokens for `seconds`, then a halved rate."""
+        with self.lock:
+            self.rate = max(self.max_rate / 4, self.rate / 2)
+            self.tokens = 0
+            # Tokens start accruing again only once the pause is over
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+    def success(self):
+        """Recover the rate additively after a request went through."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 4)
+
+
+class HostPacer:
+    """Thread-safe per-host delay: requests to one host start `delay` seconds apart.
+
+    Each wait() reserves the host's next free slot before sleeping, so
+    concurrent workers queue up behind each other instead of all firing
+    once the delay has passed. Requests to other hosts never wait.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host: str):
+        """Block until a request to host may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, 0.0))
+            self.next_slot[host] = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def if_modified_since(dest) -> dict:
+    """Conditional-request headers for revalidating an existing download.
+
+    Empty when dest is missing or empty, so the file is fetched in full.
+    """
+    try:
+        st = dest.stat()
+    except FileNotFoundError:
+        return {}
+    if st.st_size == 0:
+        return {}
+    return {"If-Modified-Since": formatdate(st.st_mtime, usegmt=True)}
+
+
+def save_response(response, dest) -> int:
+    """Stream a response body to dest in fixed-size chunks; return its size.
+
+    The body goes to a .part file that is renamed into place when complete,
+    so an interrupted transfer never leaves a truncated file behind that a
+    later run would mistake for a finished download.
+    """
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + ".part")
+    total = 0
+    try:
+        with open(tmp, "wb") as f:
+            while chunk := response.read(CHUNK_SIZE):
+                f.write(chunk)
+                total += len(chunk)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return total
+
+
+def map_unordered(func, items, workers: int = 3):
+    """Run func(item) on a thread pool; yield (item, result) as calls complete.
+
+    Items are submitted as earlier ones finish, at most 2 * workers at a
+    time, rather than all up front.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(func, item): item for item in itertools.islice(items, 2 * workers)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                # Refill before handing the result out, so workers stay busy
+                for next_item in itertools.islice(items, 1):
+                    pending[executor.submit(func, next_item)] = next_item
+                yield item, future.result()
+
+
+def download_many(download, tasks, workers: int = 3, delay: float = 0):
+    """Run download(url, dest) for each (key, url, dest) task.
+
+    Yields (key, result) as downloads complete. With a delay, each worker
+    pauses that many seconds after every request to stay polite to the host.
+    """
+    def run(task):
+        key, url, dest = task
+        try:
+            return download(url, dest)
+        finally:
+            if delay:
+                time.sleep(delay)
+
+    for (key, url, dest), result in map_unordered(run, tasks, workers):
+        yield key, result
@@ -8,24 +8,40 @@ Wikimedia Commons has organized categories like:
 
 This queries those categories to find flag files, then matches them
 to our municipality database by name similarity.
+
+Usage:
+  python3 scripts/fetch-commons-category-flags.py [--workers N] [--refresh]
 """
 
+import argparse
 import json
-import time
+import os
+import functools
 import re
 import unicodedata
 import hashlib
 import urllib.request
 import urllib.parse
+import urllib.error
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+import http_session
+from downloader import TokenBucket, download_many, if_modified_since, retry_after, save_response
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 COMMONS_API = "https://commons.wikimedia.org/w/api.php"
 REQUEST_TIMEOUT = 30
 REQUEST_DELAY = 0.5
+DOWNLOAD_DELAY = 0.2  # per worker, between file downloads
+MAX_WORKERS = 3
+CATEGORY_WORKERS = 4  # concurrent category lookups (one state each)
+API_RATE = TokenBucket(rate=1 / REQUEST_DELAY, capacity=CATEGORY_WORKERS)  # Commons API requests per second
+RATE_LIMIT_RETRIES = 3
 
 UF_NAMES_PT = {
     "AC": "Acre", "AL": "Alagoas", "AP": "Amapá", "AM": "Amazonas",
@@ -49,55 +65,112 @@ CATEGORY_PATTERNS = [
     "Bandeiras de municípios da {state}",
 ]
 
-
+# UF -> category names to try, in CATEGORY_PATTERNS order
+CATEGORY_CANDIDATES = {
+    uf: [pattern.format(state=state_name) for pattern in CATEGORY_PATTERNS]
+    for uf, state_name in UF_NAMES_PT.items()
+}
+# UF -> category that returned files on the last run
+WINNING_CATEGORIES_PATH = DATA_DIR / "commons-winning-categories.json"
+
+# Category members kept as flag candidates (lowercased title suffixes)
+FLAG_EXTS = (".svg", ".png", ".jpg", ".jpeg", ".gif")
+FILE_EXT_RE = re.compile(r"\.(svg|png|jpg|jpeg|gif|webp)$", re.IGNORECASE)
+FILE_PREFIX_RE = re.compile(r"^(File:|Ficheiro:|Arquivo:)")
+# "Bandeira de/do/da [Município de] X", "Bandeira municipal de X", "Bandeira X";
+# alternatives are tried in that order, so the first form that fits wins
+FLAG_NAME_RE = re.compile(
+    r"(?:Bandeira|Flag)\s+"
+    r"(?:(?:de|do|da|of|del?)\s+(?:Município\s+de\s+)?|municipal\s+de\s+)?"
+    r"(.+)",
+    re.IGNORECASE,
+)
+STATE_SUFFIX_RE = re.compile(r"\s*[\(-].*$")
+# ASCII bytes that may not appear in a download slug (everything but a-z, 0-9, "-")
+SLUG_DELETE = bytes(b for b in range(128) if not (chr(b).isdigit() or chr(b).islower() or b == ord("-")))
+
+
+@functools.lru_cache(maxsize=None)
 def normalize(text: str) -> str:
     """Normalize text for comparison."""
-    text = unicodedata.normalize("NFKD", text)
-    text = text.encode("ascii", "ignore").decode("ascii")
+    # Plain ASCII names have no accents to strip
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = text.encode("ascii", "ignore").decode("ascii")
     return text.lower().strip()
 
 
-def get_category_members(category_name: str) -> list:
-    """Get all files in a Commons category."""
-    members = []
-    cmcontinue = None
+def get_category_members(category_name: str) -> dict:
+    """Get all files in a Commons category as {title: direct file URL}.
+
+    generator=categorymembers + prop=imageinfo returns each file's upload URL
+    in the same response, and the requests share one kept-alive connection.
+    """
+    members = {}
+    params = {
+        "action": "query",
+        "generator": "categorymembers",
+        "gcmtitle": f"Category:{category_name}",
+        "gcmtype": "file",
+        "gcmlimit": "500",
+        "prop": "imageinfo",
+        "iiprop": "url",
+        "format": "json",
+        "formatversion": "2",
+    }
+    rate_limit_retries = RATE_LIMIT_RETRIES
 
     while True:
-        params = {
-            "action": "query",
-            "list": "categorymembers",
-            "cmtitle": f"Category:{category_name}",
-            "cmtype": "file",
-            "cmlimit": "500",
-            "format": "json",
-        }
-        if cmcontinue:
-            params["cmcontinue"] = cmcontinue
-
         url = f"{COMMONS_API}?{urllib.parse.urlencode(params)}"
         req = urllib.request.Request(url, headers={
             "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+            "Accept-Encoding": "gzip",
         })
 
+        API_RATE.acquire()
         try:
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                data = json.loads(response.read().decode("utf-8"))
-                cm = data.get("query", {}).get("categorymembers", [])
-                members.extend(cm)
-
-                cont = data.get("continue", {})
-                if "cmcontinue" in cont:
-                    cmcontinue = cont["cmcontinue"]
-                    time.sleep(REQUEST_DELAY)
-                else:
-                    break
+            with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                data = json.loads(http_session.read_body(response))
+            API_RATE.success()
+        except urllib.error.HTTPError as e:
+            # Back off (every worker, via the shared bucket) when the API asks us to
+            if e.code == 429 and rate_limit_retries > 0:
+                rate_limit_retries -= 1
+                wait = retry_after(e.headers)
+                API_RATE.pause(REQUEST_DELAY * 10 if wait is None else wait)
+                continue
+            print(f"    Error fetching category '{category_name}': {e}")
+            break
         except Exception as e:
             print(f"    Error fetching category '{category_name}': {e}")
             break
 
+        for page in data.get("query", {}).get("pages", []):
+            title = page.get("title")
+            if not title:
+                continue
+            info = page.get("imageinfo")
+            # imageinfo may arrive on a later continuation page
+            if info or title not in members:
+                members[title] = info[0].get("url") if info else None
+
+        cont = data.get("continue")
+        if not cont:
+            break
+        params.update(cont)
+
     return members
 
 
+def find_state_category(candidates: list) -> tuple:
+    """Try category names in order; return (category, members) of the first non-empty one."""
+    for cat_name in candidates:
+        members = get_category_members(cat_name)
+        if members:
+            return cat_name, members  # Found a working category
+    return None, {}
+
+
 def extract_municipality_name(filename: str) -> str:
     """Try to extract municipality name from a flag filename."""
     # Common patterns:
@@ -108,55 +181,81 @@ def extract_municipality_name(filename: str) -> str:
 
     name = filename
     # Remove file extension
-    name = re.sub(r"\.(svg|png|jpg|jpeg|gif|webp)$", "", name, flags=re.IGNORECASE)
+    name = FILE_EXT_RE.sub("", name)
     # Remove "File:" prefix
-    name = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", name)
-
-    # Try known patterns
-    patterns = [
-        r"(?:Bandeira|Flag)\s+(?:de|do|da|of|del?)\s+(?:Município\s+de\s+)?(.+)",
-        r"(?:Bandeira|Flag)\s+(?:municipal\s+de\s+)(.+)",
-        r"(?:Bandeira|Flag)\s+(.+)",
-    ]
-
-    for pattern in patterns:
-        match = re.match(pattern, name, re.IGNORECASE)
-        if match:
-            extracted = match.group(1).strip()
-            # Remove trailing state info like " (São Paulo)" or " - SP"
-            extracted = re.sub(r"\s*[\(-].*$", "", extracted)
-            return extracted
+    name = FILE_PREFIX_RE.sub("", name)
+
+    match = FLAG_NAME_RE.match(name)
+    if match:
+        extracted = match.group(1).strip()
+        # Remove trailing state info like " (São Paulo)" or " - SP"
+        return STATE_SUFFIX_RE.sub("", extracted)
 
     return name
 
 
+def flag_slug(name: str) -> str:
+    """Lowercase name, spaces to hyphens, keeping only [a-z0-9-]."""
+    # Dropping non-ASCII in encode() and the rest in translate() avoids the regex engine
+    text = name.lower().replace(" ", "-").encode("ascii", "ignore")
+    return text.translate(None, SLUG_DELETE).decode("ascii")
+
+
 def get_commons_url(filename: str) -> str:
     """Build Wikimedia Commons URL."""
     fname = filename.replace(" ", "_")
-    fname = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", fname)
+    fname = FILE_PREFIX_RE.sub("", fname)
     md5 = hashlib.md5(fname.encode("utf-8")).hexdigest()
     return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[0:2]}/{urllib.parse.quote(fname)}"
 
 
-def download_file(url: str, dest: Path) -> tuple:
-    """Download a file."""
+def download_file(url: str, dest: Path, refresh: bool = False) -> tuple:
+    """Download a file. With refresh, revalidate an existing dest (size 0 on 304)."""
     try:
-        req = urllib.request.Request(url, headers={
+        headers = {
             "User-Agent": "BandeirasmunicipiosBR/2.0 Python/3",
-        })
-        with urllib.request.urlopen(req, timeout=30) as response:
-            data = response.read()
-            if len(data) < 100:
-                return (False, "File too small")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                f.write(data)
-            return (True, len(data))
+        }
+        if refresh:
+            headers.update(if_modified_since(dest))
+        req = urllib.request.Request(url, headers=headers)
+        with http_session.urlopen(req, timeout=30) as response:
+            if response.status == 304:
+                response.read()
+                return (True, 0)
+            size = save_response(response, dest)
+        if size < 100:
+            dest.unlink()
+            return (False, "File too small")
+        return (True, size)
     except Exception as e:
         return (False, str(e))
 
 
+def scan_existing_flags() -> dict:
+    """Map UF -> {filename: size} for everything already in raw-flags/{UF}/."""
+    existing = {}
+    if not RAW_FLAGS_DIR.is_dir():
+        return existing
+    with os.scandir(RAW_FLAGS_DIR) as uf_dirs:
+        for uf_dir in uf_dirs:
+            if uf_dir.is_dir():
+                with os.scandir(uf_dir.path) as it:
+                    existing[uf_dir.name] = {e.name: e.stat().st_size for e in it if e.is_file()}
+    return existing
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Fetch flags from Wikimedia Commons categories")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of parallel downloads (default: {MAX_WORKERS})"
+    )
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="Re-check flags already on disk and fetch only those changed on Commons"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 WIKIMEDIA COMMONS CATEGORY SCRAPER")
     print("=" * 60)
@@ -174,45 +273,60 @@ def main():
         print("  All flags already found!")
         return
 
-    # Build name lookup
+    # Build name lookup, normalizing each name once
     by_name_uf = {}
-    for m in missing:
-        key = (normalize(m["name"]), m["uf"])
-        by_name_uf[key] = m
-
-    # Also build partial name lookup (first significant word)
+    # Also build partial name lookup (first significant word) -> [(municipality, name words)]
     by_partial = {}
     for m in missing:
-        words = normalize(m["name"]).split()
-        for word in words:
+        name_normalized = normalize(m["name"])
+        by_name_uf[(name_normalized, m["uf"])] = m
+        name_words = frozenset(name_normalized.split())
+        for word in name_words:
             if len(word) >= 4:
-                by_partial.setdefault((word, m["uf"]), []).append(m)
+                by_partial.setdefault((word, m["uf"]), []).append((m, name_words))
 
     # Search Commons categories for each state
     print(f"\n  Step 1/2: Searching Wikimedia Commons categories...")
-    all_flag_files = {}  # filename -> category
-
-    for uf, state_name in tqdm(sorted(UF_NAMES_PT.items()), desc="  Scanning categories", unit="state"):
-        uf_missing = sum(1 for m in missing if m["uf"] == uf)
-        if uf_missing == 0:
-            continue
-
-        for pattern in CATEGORY_PATTERNS:
-            cat_name = pattern.format(state=state_name)
-            members = get_category_members(cat_name)
-            if members:
-                for member in members:
-                    title = member.get("title", "")
-                    if title and any(title.lower().endswith(ext) for ext in [".svg", ".png", ".jpg", ".jpeg", ".gif"]):
-                        all_flag_files[title] = {"category": cat_name, "uf": uf}
-                break  # Found a working category
-            time.sleep(REQUEST_DELAY)
+    all_flag_files = {}  # filename -> category, uf, url
+
+    missing_ufs = sorted({m["uf"] for m in missing} & CATEGORY_CANDIDATES.keys())
+
+    # Try the category that worked last time first; the rest only on a miss
+    known = {}
+    if WINNING_CATEGORIES_PATH.exists():
+        with open(WINNING_CATEGORIES_PATH, "r", encoding="utf-8") as f:
+            known = json.load(f)
+    candidates = []
+    for uf in missing_ufs:
+        cats = CATEGORY_CANDIDATES[uf]
+        if known.get(uf) in cats:
+            cats = [known[uf]] + [c for c in cats if c != known[uf]]
+        candidates.append(cats)
+
+    # States are independent, so look them up concurrently; results are
+    # merged in UF order so earlier states still win duplicate filenames
+    with ThreadPoolExecutor(max_workers=CATEGORY_WORKERS) as executor:
+        found = list(tqdm(
+            executor.map(find_state_category, candidates),
+            total=len(candidates), desc="  Scanning categories", unit="state",
+        ))
+
+    for uf, (cat_name, members) in zip(missing_ufs, found):
+        if cat_name:
+            known[uf] = cat_name
+        for title, file_url in members.items():
+            if title.lower().endswith(FLAG_EXTS):
+                all_flag_files[title] = {"category": cat_name, "uf": uf, "url": file_url}
+
+    save_json(WINNING_CATEGORIES_PATH, dict(sorted(known.items())))
 
     print(f"\n  📁 Found {len(all_flag_files)} flag files in Commons categories")
 
     # Match files to municipalities
     print(f"\n  Step 2/2: Matching files to municipalities...")
-    matched = []
+    # ibge_code -> match for that municipality: the first exact match,
+    # else the first partial one
+    matched_by_code = {}
     unmatched_files = []
 
     for filename, info in tqdm(all_flag_files.items(), desc="  Matching names", unit="file"):
@@ -224,19 +338,23 @@ def main():
         key = (extracted_normalized, uf)
         if key in by_name_uf:
             m = by_name_uf[key]
-            matched.append({
+            previous = matched_by_code.get(m["ibge_code"])
+            if previous is not None and previous["matched_by"] == "exact":
+                continue
+            matched_by_code[m["ibge_code"]] = {
                 "ibge_code": m["ibge_code"],
                 "name": m["name"],
                 "uf": m["uf"],
-                "flag_file": re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", filename),
-                "flag_url": get_commons_url(filename),
+                "flag_file": FILE_PREFIX_RE.sub("", filename),
+                "flag_url": info["url"] or get_commons_url(filename),
                 "category": info["category"],
                 "matched_by": "exact",
-            })
+            }
             continue
 
         # Try partial match
         words = extracted_normalized.split()
+        extracted_words = frozenset(words)
         found_match = False
         for word in words:
             if len(word) >= 4 and (word, uf) in by_partial:
@@ -244,20 +362,19 @@ def main():
                 # Find best match — most words in common
                 best = None
                 best_score = 0
-                for cand in candidates:
-                    cand_norm = normalize(cand["name"])
-                    common = len(set(extracted_normalized.split()) & set(cand_norm.split()))
+                for cand, cand_words in candidates:
+                    common = len(extracted_words & cand_words)
                     if common > best_score:
                         best_score = common
                         best = cand
 
                 if best and best_score >= 1:
-                    matched.append({
+                    matched_by_code.setdefault(best["ibge_code"], {
                         "ibge_code": best["ibge_code"],
                         "name": best["name"],
                         "uf": best["uf"],
-                        "flag_file": re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", filename),
-                        "flag_url": get_commons_url(filename),
+                        "flag_file": FILE_PREFIX_RE.sub("", filename),
+                        "flag_url": info["url"] or get_commons_url(filename),
                         "category": info["category"],
                         "matched_by": f"partial ({best_score} words)",
                     })
@@ -271,26 +388,24 @@ def main():
                 "uf": uf,
             })
 
-    # Deduplicate (keep first match per ibge_code)
-    seen_codes = set()
-    unique_matched = []
-    for m in matched:
-        if m["ibge_code"] not in seen_codes:
-            seen_codes.add(m["ibge_code"])
-            unique_matched.append(m)
-    matched = unique_matched
+    matched = list(matched_by_code.values())
 
     print(f"\n  ✅ Matched {len(matched)} flags to municipalities")
     if unmatched_files:
         print(f"  ❓ {len(unmatched_files)} files couldn't be matched")
 
     # Save results
-    results_path = DATA_DIR / "commons-category-flags.json"
+    # One JSON record per line: a header, then "matched" and "unmatched" records,
+    # so the results can be streamed or inspected with grep/jq -c
+    results_path = DATA_DIR / "commons-category-flags.ndjson"
+    unmatched_sample = unmatched_files[:100]  # limit size
     with open(results_path, "w", encoding="utf-8") as f:
-        json.dump({
-            "matched": matched,
-            "unmatched_files": unmatched_files[:100],  # limit size
-        }, f, ensure_ascii=False, indent=2)
+        f.write(json.dumps({"type": "header", "matched": len(matched),
+                            "unmatched": len(unmatched_sample)}, ensure_ascii=False) + "\n")
+        for r in matched:
+            f.write(json.dumps({"type": "matched", **r}, ensure_ascii=False) + "\n")
+        for u in unmatched_sample:
+            f.write(json.dumps({"type": "unmatched", **u}, ensure_ascii=False) + "\n")
 
     # Download and update database
     if matched:
@@ -299,36 +414,40 @@ def main():
         total_bytes = 0
         errors = []
 
-        for result in tqdm(matched, desc="  Downloading flags", unit="file"):
+        # Skip files already on disk before touching the network
+        existing = scan_existing_flags()
+        to_fetch = []
+        for result in matched:
             ext = Path(result["flag_file"]).suffix.lower()
-            slug = re.sub(r"[^a-z0-9-]", "", result["name"].lower().replace(" ", "-"))
-            dest = RAW_FLAGS_DIR / result["uf"] / f"{result['ibge_code']}-{slug}{ext}"
-
-            if dest.exists() and dest.stat().st_size > 0:
+            slug = flag_slug(result["name"])
+            filename = f"{result['ibge_code']}-{slug}{ext}"
+            if existing.get(result["uf"], {}).get(filename, 0) > 0 and not args.refresh:
                 downloaded += 1
-                continue
-
-            ok, size_or_error = download_file(result["flag_url"], dest)
+            else:
+                to_fetch.append((result, RAW_FLAGS_DIR / result["uf"] / filename))
+
+        jobs = [(result, result["flag_url"], dest) for result, dest in to_fetch]
+        for result, (ok, size_or_error) in tqdm(
+            download_many(functools.partial(download_file, refresh=args.refresh),
+                          jobs, args.workers, delay=DOWNLOAD_DELAY),
+            total=len(jobs), desc="  Downloading flags", unit="file",
+        ):
             if ok:
                 downloaded += 1
                 total_bytes += size_or_error
             else:
                 errors.append({**result, "error": size_or_error})
 
-            time.sleep(0.2)
-
         # Update database
-        matched_codes = {r["ibge_code"] for r in matched}
         for m in municipios:
-            if m["ibge_code"] in matched_codes and m["flag_status"] != "found":
-                result = next(r for r in matched if r["ibge_code"] == m["ibge_code"])
+            result = matched_by_code.get(m["ibge_code"])
+            if result and m["flag_status"] != "found":
                 m["flag_status"] = "found"
                 m["flag_source"] = "commons-category"
                 m["flag_url"] = result["flag_url"]
                 m["flag_file"] = result["flag_file"]
 
-        with open(db_path, "w", encoding="utf-8") as f:
-            json.dump(municipios, f, ensure_ascii=False, indent=2)
+        save_municipios(db_path, municipios)
 
         mb = total_bytes / (1024 * 1024)
         print(f"\n  💾 Downloaded {downloaded} flags ({mb:.1f} MB)")
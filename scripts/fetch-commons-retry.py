@@ -2,9 +2,19 @@
 """
 Retry Wikimedia Commons category scraper for states missed due to 429 errors.
 
-Uses longer delays and individual requests (no threading) to avoid rate limits.
+Uses longer delays and individual requests (no threading) against the
+Commons API to avoid rate limits. Matched files are then downloaded from
+upload.wikimedia.org with a few parallel workers.
+
+Usage:
+  python3 scripts/fetch-commons-retry.py [--workers N] [--refresh]
+
+--refresh re-requests flags that are already on disk with If-Modified-Since,
+so unchanged files cost a 304 instead of a full download.
 """
 
+import argparse
+import functools
 import json
 import time
 import re
@@ -15,12 +25,22 @@ import urllib.parse
 from pathlib import Path
 from tqdm import tqdm
 
+import http_session
+from downloader import (
+    TokenBucket, backoff_delay, download_many, if_modified_since, retry_after,
+    save_response,
+)
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 COMMONS_API = "https://commons.wikimedia.org/w/api.php"
 REQUEST_TIMEOUT = 30
 REQUEST_DELAY = 2.0  # Longer delay to avoid 429s
+API_RATE = TokenBucket(rate=1 / REQUEST_DELAY)  # Commons API requests, paced and backed off on 429
+DOWNLOAD_DELAY = 0.3  # per worker, between file downloads
+MAX_WORKERS = 3
 
 UF_NAMES_PT = {
     "AC": "Acre", "AL": "Alagoas", "AP": "Amapá", "AM": "Amazonas",
@@ -47,9 +67,27 @@ CATEGORY_PATTERNS = [
 ]
 
 
+# Category members kept as flag candidates (lowercased title suffixes)
+FLAG_EXTS = (".svg", ".png", ".jpg", ".jpeg", ".gif")
+FILE_EXT_RE = re.compile(r"\.(svg|png|jpg|jpeg|gif|webp)$", re.IGNORECASE)
+FILE_PREFIX_RE = re.compile(r"^(File:|Ficheiro:|Arquivo:)")
+# "Bandeira de/do/da [Município de] X", "Bandeira municipal de X", "Bandeira X";
+# alternatives are tried in that order, so the first form that fits wins
+FLAG_NAME_RE = re.compile(
+    r"(?:Bandeira|Flag)\s+"
+    r"(?:(?:de|do|da|of|del?)\s+(?:Município\s+de\s+)?|municipal\s+de\s+)?"
+    r"(.+)",
+    re.IGNORECASE,
+)
+STATE_SUFFIX_RE = re.compile(r"\s*[\(-].*$")
+
+
+@functools.lru_cache(maxsize=None)
 def normalize(text: str) -> str:
-    text = unicodedata.normalize("NFKD", text)
-    text = text.encode("ascii", "ignore").decode("ascii")
+    # Plain ASCII names have no accents to strip
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = text.encode("ascii", "ignore").decode("ascii")
     return text.lower().strip()
 
 
@@ -73,12 +111,15 @@ def get_category_members(category_name: str, max_retries: int = 3) -> list:
         url = f"{COMMONS_API}?{urllib.parse.urlencode(params)}"
 
         for attempt in range(max_retries):
+            API_RATE.acquire()
             req = urllib.request.Request(url, headers={
                 "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+                "Accept-Encoding": "gzip",
             })
             try:
-                with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                    data = json.loads(response.read().decode("utf-8"))
+                with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                    data = json.loads(http_session.read_body(response))
+                    API_RATE.success()
                     cm = data.get("query", {}).get("categorymembers", [])
                     members.extend(cm)
 
@@ -90,66 +131,74 @@ def get_category_members(category_name: str, max_retries: int = 3) -> list:
                     break  # Success, go to next page
             except urllib.error.HTTPError as e:
                 if e.code == 429:
-                    wait = REQUEST_DELAY * (attempt + 2)
-                    print(f"      429 rate limited, waiting {wait}s...")
-                    time.sleep(wait)
+                    wait = retry_after(e.headers)
+                    if wait is None:
+                        wait = REQUEST_DELAY * 2 ** (attempt + 1)
+                    print(f"      429 rate limited, waiting {wait:.0f}s...")
+                    API_RATE.pause(wait)
                 else:
                     return members
             except Exception:
-                time.sleep(REQUEST_DELAY)
-
-        time.sleep(REQUEST_DELAY)
-
-    return members
+                time.sleep(backoff_delay(attempt, REQUEST_DELAY))
+        else:
+            return members  # This page kept failing; keep what we have
 
 
 def extract_municipality_name(filename: str) -> str:
     """Try to extract municipality name from a flag filename."""
     name = filename
-    name = re.sub(r"\.(svg|png|jpg|jpeg|gif|webp)$", "", name, flags=re.IGNORECASE)
-    name = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", name)
-
-    patterns = [
-        r"(?:Bandeira|Flag)\s+(?:de|do|da|of|del?)\s+(?:Município\s+de\s+)?(.+)",
-        r"(?:Bandeira|Flag)\s+(?:municipal\s+de\s+)(.+)",
-        r"(?:Bandeira|Flag)\s+(.+)",
-    ]
-
-    for pattern in patterns:
-        match = re.match(pattern, name, re.IGNORECASE)
-        if match:
-            extracted = match.group(1).strip()
-            extracted = re.sub(r"\s*[\(-].*$", "", extracted)
-            return extracted
+    name = FILE_EXT_RE.sub("", name)
+    name = FILE_PREFIX_RE.sub("", name)
+
+    match = FLAG_NAME_RE.match(name)
+    if match:
+        extracted = match.group(1).strip()
+        return STATE_SUFFIX_RE.sub("", extracted)
 
     return name
 
 
 def get_commons_url(filename: str) -> str:
     fname = filename.replace(" ", "_")
-    fname = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", fname)
+    fname = FILE_PREFIX_RE.sub("", fname)
     md5 = hashlib.md5(fname.encode("utf-8")).hexdigest()
     return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[0:2]}/{urllib.parse.quote(fname)}"
 
 
-def download_file(url: str, dest: Path) -> tuple:
+def download_file(url: str, dest: Path, refresh: bool = False) -> tuple:
+    """Download a file. With refresh, revalidate an existing dest (size 0 on 304)."""
     try:
-        req = urllib.request.Request(url, headers={
+        headers = {
             "User-Agent": "BandeirasmunicipiosBR/2.0 Python/3",
-        })
-        with urllib.request.urlopen(req, timeout=30) as response:
-            data = response.read()
-            if len(data) < 100:
-                return (False, "File too small")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                f.write(data)
-            return (True, len(data))
+        }
+        if refresh:
+            headers.update(if_modified_since(dest))
+        req = urllib.request.Request(url, headers=headers)
+        with http_session.urlopen(req, timeout=30) as response:
+            if response.status == 304:
+                response.read()
+                return (True, 0)
+            size = save_response(response, dest)
+        if size < 100:
+            dest.unlink()
+            return (False, "File too small")
+        return (True, size)
     except Exception as e:
         return (False, str(e))
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Retry Commons category scraping for missed states")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of parallel file downloads (default: {MAX_WORKERS})"
+    )
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="Re-check flags already on disk and fetch only those changed on Commons"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 COMMONS CATEGORY SCRAPER (RETRY)")
     print("=" * 60)
@@ -165,27 +214,27 @@ def main():
         print("  All flags already found!")
         return
 
-    # Build lookup
+    # Build lookup, normalizing each name once; by_partial entries carry
+    # the candidate's word set so matching never re-normalizes it
     by_name_uf = {}
-    for m in missing:
-        key = (normalize(m["name"]), m["uf"])
-        by_name_uf[key] = m
-
     by_partial = {}
     for m in missing:
-        words = normalize(m["name"]).split()
-        for word in words:
+        name_normalized = normalize(m["name"])
+        by_name_uf[(name_normalized, m["uf"])] = m
+        name_words = frozenset(name_normalized.split())
+        for word in name_words:
             if len(word) >= 4:
-                by_partial.setdefault((word, m["uf"]), []).append(m)
+                by_partial.setdefault((word, m["uf"]), []).append((m, name_words))
 
     # Check which states already have Commons data
-    existing_path = DATA_DIR / "commons-category-flags.json"
+    existing_path = DATA_DIR / "commons-category-flags.ndjson"
     already_covered = set()
     if existing_path.exists():
-        with open(existing_path) as f:
-            existing = json.load(f)
-        for m in existing.get("matched", []):
-            already_covered.add(m["uf"])
+        with open(existing_path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] == "matched":
+                    already_covered.add(record["uf"])
 
     # Only search states that still have missing municipalities
     states_to_search = set()
@@ -208,13 +257,12 @@ def main():
         found_category = False
         for pattern in CATEGORY_PATTERNS:
             cat_name = pattern.format(state=state_name)
-            time.sleep(REQUEST_DELAY)  # Be respectful
             members = get_category_members(cat_name)
             if members:
                 print(f"    {uf}: Found {len(members)} files in '{cat_name}'")
                 for member in members:
                     title = member.get("title", "")
-                    if title and any(title.lower().endswith(ext) for ext in [".svg", ".png", ".jpg", ".jpeg", ".gif"]):
+                    if title and title.lower().endswith(FLAG_EXTS):
                         all_flag_files[title] = {"category": cat_name, "uf": uf}
                 found_category = True
                 break
@@ -226,7 +274,9 @@ def main():
 
     # Match
     print(f"\n  Step 2/2: Matching files to municipalities...")
-    matched = []
+    # ibge_code -> match for that municipality: the first exact match,
+    # else the first partial one
+    matched_by_code = {}
     unmatched_files = []
 
     for filename, info in all_flag_files.items():
@@ -237,36 +287,39 @@ def main():
         key = (extracted_normalized, uf)
         if key in by_name_uf:
             m = by_name_uf[key]
-            matched.append({
+            previous = matched_by_code.get(m["ibge_code"])
+            if previous is not None and previous["matched_by"] == "exact":
+                continue
+            matched_by_code[m["ibge_code"]] = {
                 "ibge_code": m["ibge_code"],
                 "name": m["name"],
                 "uf": m["uf"],
-                "flag_file": re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", filename),
+                "flag_file": FILE_PREFIX_RE.sub("", filename),
                 "flag_url": get_commons_url(filename),
                 "category": info["category"],
                 "matched_by": "exact",
-            })
+            }
             continue
 
         words = extracted_normalized.split()
+        extracted_words = frozenset(words)
         found_match = False
         for word in words:
             if len(word) >= 4 and (word, uf) in by_partial:
                 candidates = by_partial[(word, uf)]
                 best = None
                 best_score = 0
-                for cand in candidates:
-                    cand_norm = normalize(cand["name"])
-                    common = len(set(extracted_normalized.split()) & set(cand_norm.split()))
+                for cand, cand_words in candidates:
+                    common = len(extracted_words & cand_words)
                     if common > best_score:
                         best_score = common
                         best = cand
                 if best and best_score >= 1:
-                    matched.append({
+                    matched_by_code.setdefault(best["ibge_code"], {
                         "ibge_code": best["ibge_code"],
                         "name": best["name"],
                         "uf": best["uf"],
-                        "flag_file": re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", filename),
+                        "flag_file": FILE_PREFIX_RE.sub("", filename),
                         "flag_url": get_commons_url(filename),
                         "category": info["category"],
                         "matched_by": f"partial ({best_score})",
@@ -276,21 +329,13 @@ def main():
         if not found_match:
             unmatched_files.append({"filename": filename, "extracted_name": extracted_name, "uf": uf})
 
-    # Deduplicate
-    seen = set()
-    unique = []
-    for m in matched:
-        if m["ibge_code"] not in seen:
-            seen.add(m["ibge_code"])
-            unique.append(m)
-    matched = unique
+    matched = list(matched_by_code.values())
 
     print(f"\n  ✅ Matched {len(matched)} flags")
 
     # Save
     results_path = DATA_DIR / "commons-retry-flags.json"
-    with open(results_path, "w", encoding="utf-8") as f:
-        json.dump({"matched": matched, "unmatched": unmatched_files[:100]}, f, ensure_ascii=False, indent=2)
+    save_json(results_path, {"matched": matched, "unmatched": unmatched_files[:100]})
 
     # Download and update
     if matched:
@@ -299,34 +344,39 @@ def main():
         total_bytes = 0
         errors = []
 
-        for result in tqdm(matched, desc="  Downloading", unit="file"):
+        jobs = []
+        for result in matched:
             ext = Path(result["flag_file"]).suffix.lower()
             slug = re.sub(r"[^a-z0-9-]", "", result["name"].lower().replace(" ", "-"))
             dest = RAW_FLAGS_DIR / result["uf"] / f"{result['ibge_code']}-{slug}{ext}"
 
-            if dest.exists() and dest.stat().st_size > 0:
+            if dest.exists() and dest.stat().st_size > 0 and not args.refresh:
                 downloaded += 1
-                continue
-
-            ok, size_or_error = download_file(result["flag_url"], dest)
+            else:
+                jobs.append((result, result["flag_url"], dest))
+
+        # File downloads go to upload.wikimedia.org, not the rate-limited API,
+        # so they can overlap; each worker still pauses between files
+        for result, (ok, size_or_error) in tqdm(
+            download_many(functools.partial(download_file, refresh=args.refresh),
+                          jobs, args.workers, delay=DOWNLOAD_DELAY),
+            total=len(jobs), desc="  Downloading", unit="file",
+        ):
             if ok:
                 downloaded += 1
                 total_bytes += size_or_error
             else:
                 errors.append({**result, "error": size_or_error})
-            time.sleep(0.3)
 
-        matched_codes = {r["ibge_code"] for r in matched}
         for m in municipios:
-            if m["ibge_code"] in matched_codes and m["flag_status"] != "found":
-                result = next(r for r in matched if r["ibge_code"] == m["ibge_code"])
+            result = matched_by_code.get(m["ibge_code"])
+            if result and m["flag_status"] != "found":
                 m["flag_status"] = "found"
                 m["flag_source"] = "commons-retry"
                 m["flag_url"] = result["flag_url"]
                 m["flag_file"] = result["flag_file"]
 
-        with open(db_path, "w", encoding="utf-8") as f:
-            json.dump(municipios, f, ensure_ascii=False, indent=2)
+        save_municipios(db_path, municipios)
 
         mb = total_bytes / (1024 * 1024)
         print(f"\n  💾 Downloaded {downloaded} flags ({mb:.1f} MB)")
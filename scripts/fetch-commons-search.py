@@ -4,19 +4,33 @@ Search Wikimedia Commons for flags of missing municipalities.
 
 Uses the Commons API search to find flag files by municipality name.
 More targeted than category browsing.
+
+Usage:
+  python3 scripts/fetch-commons-search.py [--workers N]
 """
 
+import argparse
+import functools
 import json
 import re
-import time
 import unicodedata
 import urllib.request
 import urllib.parse
 import hashlib
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+from downloader import TokenBucket, retry_after
+from municipios_db import save_json
 
 DATA_DIR = Path(__file__).parent.parent / "data"
 
+# Rate limit - Wikimedia enforces strict limits; shared by all workers
+API_RATE = TokenBucket(rate=1, capacity=2)  # search requests per second
+MAX_WORKERS = 2
+SAVE_EVERY = 50
+
 STATE_FLAGS_LOWER = {
     "bandeira do acre", "bandeira de alagoas", "bandeira do amapa",
     "bandeira do amazonas", "bandeira da bahia", "bandeira do ceara",
@@ -31,8 +45,11 @@ STATE_FLAGS_LOWER = {
     "bandeira de sao paulo", "bandeira de sergipe",
     "bandeira do tocantins", "bandeira do brasil",
 }
+# One pass over the filename instead of a substring test per state
+STATE_FLAGS_RE = re.compile("|".join(map(re.escape, sorted(STATE_FLAGS_LOWER))))
 
 
+@functools.lru_cache(maxsize=None)
 def normalize(text):
     text = unicodedata.normalize("NFD", text.lower())
     return "".join(c for c in text if unicodedata.category(c) != "Mn")
@@ -55,9 +72,8 @@ def is_valid_flag(filename, municipality_name):
         return False
 
     # Reject state/national flags
-    for sf in STATE_FLAGS_LOWER:
-        if sf in fn:
-            return False
+    if STATE_FLAGS_RE.search(fn):
+        return False
 
     # Reject brasão-only files
     if "brasao" in fn and "bandeira" not in fn:
@@ -91,16 +107,21 @@ def search_commons(municipality_name, uf):
         url = "https://commons.wikimedia.org/w/api.php?" + urllib.parse.urlencode(params)
         req = urllib.request.Request(url, headers={
             "User-Agent": "BandeirasmunicipiosBR/1.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+            "Accept-Encoding": "gzip",
         })
         for attempt in range(3):
+            API_RATE.acquire()
             try:
-                with urllib.request.urlopen(req, timeout=15) as resp:
-                    data = json.load(resp)
+                with http_session.urlopen(req, timeout=15) as resp:
+                    data = json.loads(http_session.read_body(resp))
+                API_RATE.success()
                 break
             except urllib.error.HTTPError as e:
                 if e.code == 429:
-                    wait = 10 * (attempt + 1)
-                    time.sleep(wait)
+                    wait = retry_after(e.headers)
+                    if wait is None:
+                        wait = 10 * 2 ** attempt
+                    API_RATE.pause(wait)
                     continue
                 break
             except Exception:
@@ -117,7 +138,19 @@ def search_commons(municipality_name, uf):
     return None
 
 
+def search_municipality(m):
+    """search_commons() for one municipality."""
+    return search_commons(m["name"], m["uf"])
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Search Wikimedia Commons for missing flags")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of municipalities searched in parallel (default: {MAX_WORKERS})"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  WIKIMEDIA COMMONS SEARCH")
     print("=" * 60)
@@ -145,29 +178,31 @@ def main():
 
     not_found = []
 
-    for i, m in enumerate(missing):
-        if i % 50 == 0 and i > 0:
-            print(f"  Progress: {i}/{len(missing)} ({len(found)} found)", flush=True)
-            # Save progress periodically
-            with open(out_path, "w", encoding="utf-8") as f:
-                json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
-
-        flag_file = search_commons(m["name"], m["uf"])
-        if flag_file:
-            found.append({
-                "ibge_code": m["ibge_code"],
-                "name": m["name"],
-                "uf": m["uf"],
-                "slug": m["slug"],
-                "flag_file": flag_file,
-                "flag_url": get_commons_url(flag_file),
-            })
-        else:
-            not_found.append(m)
-
-        time.sleep(2)  # Rate limit - Wikimedia enforces strict limits
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    # Searches run on a few workers, one batch at a time, so progress is
+    # saved in order every SAVE_EVERY municipalities and a resume never
+    # skips one that was still in flight
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for start in range(0, len(missing), SAVE_EVERY):
+            if start > 0:
+                print(f"  Progress: {start}/{len(missing)} ({len(found)} found)", flush=True)
+                # Save progress periodically
+                save_json(out_path, {"found": found, "not_found": not_found})
+
+            batch = missing[start:start + SAVE_EVERY]
+            for m, flag_file in zip(batch, executor.map(search_municipality, batch)):
+                if flag_file:
+                    found.append({
+                        "ibge_code": m["ibge_code"],
+                        "name": m["name"],
+                        "uf": m["uf"],
+                        "slug": m["slug"],
+                        "flag_file": flag_file,
+                        "flag_url": get_commons_url(flag_file),
+                    })
+                else:
+                    not_found.append(m)
+
+    save_json(out_path, {"found": found, "not_found": not_found})
 
     print(f"\n{'=' * 60}")
     print(f"  RESULTS")
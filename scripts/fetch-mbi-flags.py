@@ -8,14 +8,22 @@ the actual flag files on Wikipedia/Commons for those municipalities.
 """
 
 import json
+import functools
 import re
 import time
+import unicodedata
 import urllib.request
 import urllib.parse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+from municipios_db import save_json
 
 DATA_DIR = Path(__file__).parent.parent / "data"
 
+MAX_WORKERS = 4  # state pages fetched in parallel
+
 UF_NAMES = {
     "AC": "acre", "AL": "alagoas", "AM": "amazonas", "AP": "amapa",
     "BA": "bahia", "CE": "ceara", "DF": "distrito-federal", "ES": "espirito-santo",
@@ -26,15 +34,62 @@ UF_NAMES = {
     "SE": "sergipe", "SP": "sao-paulo", "TO": "tocantins",
 }
 
+NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+MBI_IMG_RE = re.compile(r'src="(/mbi/files/media/image/simbolopedia/municipio-([^"]*)-bandeira-mini-([^"]*?)\.jpg)"')
+
+
+@functools.lru_cache(maxsize=None)
 def normalize(name):
     """Normalize municipality name for matching."""
-    import unicodedata
     name = unicodedata.normalize("NFD", name.lower())
     name = "".join(c for c in name if unicodedata.category(c) != "Mn")
-    name = re.sub(r"[^a-z0-9]", "", name)
+    name = NON_ALNUM_RE.sub("", name)
     return name
 
 
+def trigrams(text):
+    """All 3-character substrings of text."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SlugIndex:
+    """Find the first MBI slug that contains, or is contained in, a slug.
+
+    Answers the same question as scanning the slugs in order with
+    `slug in mbi or mbi in slug`, without the scan: slugs inside `slug` are
+    found by looking up each of its substrings, and slugs containing it
+    must share all of its trigrams.
+    """
+
+    def __init__(self, slugs):
+        self.slugs = list(slugs)
+        self.lengths = sorted({len(slug) for slug in self.slugs})
+        self.position = {}
+        self.by_trigram = {}
+        for i, slug in enumerate(self.slugs):
+            self.position.setdefault(slug, i)
+            for tri in trigrams(slug):
+                self.by_trigram.setdefault(tri, set()).add(i)
+
+    def first_overlap(self, slug):
+        """Index of the first slug overlapping `slug`, or None."""
+        hits = set()
+        for n in self.lengths:
+            if n > len(slug):
+                break
+            for i in range(len(slug) - n + 1):
+                pos = self.position.get(slug[i:i + n])
+                if pos is not None:
+                    hits.add(pos)
+        postings = [self.by_trigram.get(tri, set()) for tri in trigrams(slug)]
+        if postings:
+            hits.update(i for i in set.intersection(*postings) if slug in self.slugs[i])
+        else:
+            # Too short for trigrams; check every slug
+            hits.update(i for i, mbi in enumerate(self.slugs) if slug in mbi)
+        return min(hits) if hits else None
+
+
 def scrape_state_page(uf, state_name):
     """Scrape MBI state page for municipality flag image URLs."""
     url = f"https://www.mbi.com.br/mbi/biblioteca/simbolopedia/municipios-estado-{state_name}-br/"
@@ -42,15 +97,14 @@ def scrape_state_page(uf, state_name):
         "User-Agent": "BandeirasmunicipiosBR/1.0 Python/3",
     })
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
+        with http_session.urlopen(req, timeout=30) as resp:
             html = resp.read().decode("utf-8", errors="ignore")
     except Exception as e:
         print(f"  Error fetching {uf}: {e}")
         return []
 
     # Extract all bandeira image URLs
-    pattern = r'src="(/mbi/files/media/image/simbolopedia/municipio-([^"]*)-bandeira-mini-([^"]*?)\.jpg)"'
-    matches = re.findall(pattern, html)
+    matches = MBI_IMG_RE.findall(html)
 
     results = []
     for full_path, slug, code_part in matches:
@@ -63,6 +117,12 @@ def scrape_state_page(uf, state_name):
     return results
 
 
+def fetch_state(uf):
+    """Scrape one state's page, pausing first to be nice to the server."""
+    time.sleep(1)  # Be nice
+    return scrape_state_page(uf, UF_NAMES[uf])
+
+
 def main():
     print("=" * 60)
     print("  MBI SIMBOLOPEDIA SCRAPER")
@@ -83,12 +143,13 @@ def main():
     all_found = []
     total_mbi = 0
 
-    for uf in ufs_to_scrape:
+    # Fetch state pages a few at a time; results come back in UF order
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pages = list(executor.map(fetch_state, ufs_to_scrape))
+
+    for uf, mbi_entries in zip(ufs_to_scrape, pages):
         state_name = UF_NAMES[uf]
         print(f"\n  {uf} ({state_name}): {len(missing_by_uf[uf])} missing...")
-        time.sleep(1)  # Be nice
-
-        mbi_entries = scrape_state_page(uf, state_name)
         total_mbi += len(mbi_entries)
 
         if not mbi_entries:
@@ -102,6 +163,8 @@ def main():
             mbi_by_slug[norm] = entry
 
         # Match missing municipalities
+        slug_index = SlugIndex(mbi_by_slug)
+        mbi_slugs = list(mbi_by_slug.items())
         matched = 0
         for m in missing_by_uf[uf]:
             norm_name = normalize(m["name"])
@@ -135,27 +198,26 @@ def main():
                 matched += 1
                 continue
 
-            # Try partial match (at least 80% of slug chars match)
-            for mbi_norm, entry in mbi_by_slug.items():
-                if len(norm_slug) > 4 and (norm_slug in mbi_norm or mbi_norm in norm_slug):
-                    all_found.append({
-                        "ibge_code": m["ibge_code"],
-                        "name": m["name"],
-                        "uf": uf,
-                        "slug": m["slug"],
-                        "mbi_slug": entry["slug"],
-                        "mbi_img": entry["img_url"],
-                        "match": "partial",
-                    })
-                    matched += 1
-                    break
+            # Try partial match: first MBI slug containing ours or contained in it
+            first = slug_index.first_overlap(norm_slug) if len(norm_slug) > 4 else None
+            if first is not None:
+                entry = mbi_slugs[first][1]
+                all_found.append({
+                    "ibge_code": m["ibge_code"],
+                    "name": m["name"],
+                    "uf": uf,
+                    "slug": m["slug"],
+                    "mbi_slug": entry["slug"],
+                    "mbi_img": entry["img_url"],
+                    "match": "partial",
+                })
+                matched += 1
 
         print(f"    MBI entries: {len(mbi_entries)}, Matched: {matched}/{len(missing_by_uf[uf])}")
 
     # Save results
     out_path = DATA_DIR / "mbi-flags.json"
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(all_found, f, ensure_ascii=False, indent=2)
+    save_json(out_path, all_found)
 
     print(f"\n{'=' * 60}")
     print(f"  RESULTS")
@@ -12,10 +12,23 @@ Strategy:
 
 This is the LAST RESORT scraper for municipalities not found via
 Wikidata or Wikipedia.
+
+Most candidate hostnames do not exist, so each one is resolved once per
+run and every page under a host without DNS records is skipped.
+
+Requests to the same host are spaced REQUEST_DELAY apart; requests to
+different hosts never wait on each other. Each worker crawls one
+municipality's candidate sites at a time, so --workers can go well above
+what one host would tolerate.
+
+Usage:
+  python3 scripts/fetch-prefeitura-flags.py [--workers N]
 """
 
+import argparse
+import functools
 import json
-import time
+import socket
 import re
 import unicodedata
 import urllib.request
@@ -25,12 +38,17 @@ from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+import http_session
+from downloader import HostPacer, download_many, save_response
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 REQUEST_TIMEOUT = 15
-MAX_WORKERS = 4
+MAX_WORKERS = 16  # municipalities crawled in parallel, each on its own hosts
 REQUEST_DELAY = 1.0  # Be respectful to gov.br sites
+PACER = HostPacer(REQUEST_DELAY)
 
 UF_LOWER = {
     "RO": "ro", "AC": "ac", "AM": "am", "RR": "rr", "PA": "pa",
@@ -41,18 +59,31 @@ UF_LOWER = {
     "GO": "go", "DF": "df",
 }
 
+NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+# Pages are scanned as raw bytes; only the matched URLs get decoded
+# <img> tags; [^>]+ is greedy so the last src= in the tag wins over data-src= etc.
+IMG_RE = re.compile(rb'<img[^>]+src=["\']([^"\']+)["\'][^>]*>', re.IGNORECASE)
+# <a> tags whose text mentions a flag
+FLAG_LINK_RE = re.compile(
+    rb'<a[^>]+href=["\']([^"\']+)["\'][^>]*>[^<]*(?:bandeira|flag)[^<]*</a>',
+    re.IGNORECASE
+)
+IMAGE_EXT_RE = re.compile(r'\.(svg|png|jpg|jpeg|webp|gif)(\?|$)')
+
+# getaddrinfo errors meaning the name definitely has no address
+NO_SUCH_HOST = {socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)}
+
 
 def slugify_prefeitura(name: str) -> str:
     """Convert municipality name to prefeitura URL slug."""
     text = unicodedata.normalize("NFKD", name)
     text = text.encode("ascii", "ignore").decode("ascii")
-    text = re.sub(r"[^a-z0-9]+", "", text.lower())
+    text = NON_ALNUM_RE.sub("", text.lower())
     return text
 
 
-def build_prefeitura_urls(name: str, uf: str) -> list:
-    """Build possible prefeitura website URLs."""
-    slug = slugify_prefeitura(name)
+def build_prefeitura_urls(slug: str, uf: str) -> list:
+    """Build possible prefeitura website URLs from a slugify_prefeitura() slug."""
     uf_lower = UF_LOWER.get(uf, uf.lower())
 
     base_urls = [
@@ -84,30 +115,45 @@ def build_prefeitura_urls(name: str, uf: str) -> list:
     return urls
 
 
-def try_fetch_page(url: str) -> str:
-    """Try to fetch a page. Returns HTML content or None."""
+@functools.lru_cache(maxsize=None)
+def host_resolves(host: str) -> bool:
+    """False if DNS says host does not exist; transient lookup errors count as True."""
+    try:
+        socket.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        return e.errno not in NO_SUCH_HOST
+    except UnicodeError:
+        return False
+    return True
+
+
+def try_fetch_page(url: str) -> bytes:
+    """Try to fetch a page. Returns the raw HTML bytes or None.
+
+    Raises OSError when the host itself could not be reached (connection
+    refused, timeout, TLS failure), as opposed to answering with an error.
+    """
     try:
         req = urllib.request.Request(url, headers={
             "User-Agent": "Mozilla/5.0 (compatible; BandeirasmunicipiosBR/1.0)",
         })
-        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+        with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
             if response.status == 200:
-                return response.read().decode("utf-8", errors="ignore")
+                return response.read()
+    except urllib.error.HTTPError:
+        pass
+    except OSError:
+        raise
     except Exception:
         pass
     return None
 
 
-def find_flag_image_in_html(html: str, base_url: str) -> str:
+def find_flag_image_in_html(html: bytes, base_url: str) -> str:
     """Search HTML for flag image URLs."""
     # Look for <img> tags with flag-related keywords
-    img_pattern = re.compile(
-        r'<img[^>]+src=["\']([^"\']+)["\'][^>]*>',
-        re.IGNORECASE
-    )
-
-    for match in img_pattern.finditer(html):
-        src = match.group(1)
+    for match in IMG_RE.finditer(html):
+        src = match.group(1).decode("utf-8", errors="ignore")
         src_lower = src.lower()
 
         # Check if this is a flag image
@@ -126,13 +172,8 @@ def find_flag_image_in_html(html: str, base_url: str) -> str:
                 return src
 
     # Also look for <a> tags linking to flag downloads
-    link_pattern = re.compile(
-        r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>[^<]*(?:bandeira|flag)[^<]*</a>',
-        re.IGNORECASE
-    )
-
-    for match in link_pattern.finditer(html):
-        href = match.group(1)
+    for match in FLAG_LINK_RE.finditer(html):
+        href = match.group(1).decode("utf-8", errors="ignore")
         href_lower = href.lower()
         if any(ext in href_lower for ext in [".svg", ".png", ".jpg", ".jpeg", ".webp"]):
             if href.startswith("/"):
@@ -145,29 +186,52 @@ def find_flag_image_in_html(html: str, base_url: str) -> str:
 
 
 def download_file(url: str, dest: Path) -> tuple:
-    """Download a file. Returns (success, size_or_error)."""
+    """Download a file. Returns (success, size_or_error).
+
+    Bad leads are rejected from the response headers where possible, before
+    any of the body is transferred.
+    """
+    PACER.wait(urllib.parse.urlsplit(url).netloc)
     try:
         req = urllib.request.Request(url, headers={
             "User-Agent": "Mozilla/5.0 (compatible; BandeirasmunicipiosBR/1.0)",
         })
-        with urllib.request.urlopen(req, timeout=30) as response:
-            data = response.read()
-            if len(data) < 500:  # Too small to be a real flag
+        with http_session.urlopen(req, timeout=30) as response:
+            length = response.headers.get("Content-Length", "")
+            if length.isdigit() and int(length) < 500:
+                response.read()  # a few bytes; keeps the connection reusable
                 return (False, "File too small")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                f.write(data)
-            return (True, len(data))
+            # e.g. a link that redirects to the site's home or error page.
+            # The page is left unread, so http_session opens a fresh
+            # connection for the next request to this host
+            if response.headers.get_content_type() == "text/html":
+                return (False, "Not an image (text/html)")
+            size = save_response(response, dest)
+        if size < 500:  # Too small to be a real flag
+            dest.unlink()
+            return (False, "File too small")
+        return (True, size)
     except Exception as e:
         return (False, str(e))
 
 
-def process_municipality(m: dict) -> dict:
+def process_municipality(m: dict, slug: str) -> dict:
     """Try to find a flag on prefeitura website."""
-    urls = build_prefeitura_urls(m["name"], m["uf"])
+    urls = build_prefeitura_urls(slug, m["uf"])
+    unreachable = set()
 
     for url in urls:
-        html = try_fetch_page(url)
+        parts = urllib.parse.urlsplit(url)
+        if parts.netloc in unreachable or not host_resolves(parts.hostname):
+            continue
+
+        PACER.wait(parts.netloc)
+        try:
+            html = try_fetch_page(url)
+        except OSError:
+            # Its other pages would only wait out the same timeout
+            unreachable.add(parts.netloc)
+            continue
         if not html:
             continue
 
@@ -182,8 +246,6 @@ def process_municipality(m: dict) -> dict:
                 "source_page": url,
             }
 
-        time.sleep(REQUEST_DELAY)
-
     return {
         "ibge_code": m["ibge_code"],
         "name": m["name"],
@@ -193,6 +255,13 @@ def process_municipality(m: dict) -> dict:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Fetch flags from prefeitura websites")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of municipalities crawled (and flags downloaded) in parallel (default: {MAX_WORKERS})"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 PREFEITURA FLAG SCRAPER")
     print("=" * 60)
@@ -210,13 +279,16 @@ def main():
         print("  All flags already found!")
         return
 
+    # Slugs are needed for both the site URLs and the download file names
+    slugs = {m["ibge_code"]: slugify_prefeitura(m["name"]) for m in missing}
+
     # Process municipalities
     print(f"\n  Step 1/2: Searching prefeitura websites...")
     found = []
     not_found = []
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_municipality, m): m for m in missing}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_municipality, m, slugs[m["ibge_code"]]): m for m in missing}
 
         with tqdm(total=len(missing), desc="  Scanning prefeituras", unit="mun") as pbar:
             for future in as_completed(futures):
@@ -230,8 +302,7 @@ def main():
 
     # Save results
     prefeitura_results_path = DATA_DIR / "prefeitura-flags.json"
-    with open(prefeitura_results_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    save_json(prefeitura_results_path, {"found": found, "not_found": not_found})
 
     # Download found flags
     if found:
@@ -239,34 +310,38 @@ def main():
         downloaded = 0
         total_bytes = 0
 
-        for result in tqdm(found, desc="  Downloading flags", unit="file"):
-            ext_match = re.search(r'\.(svg|png|jpg|jpeg|webp|gif)(\?|$)', result["flag_url"].lower())
+        jobs = []
+        for result in found:
+            ext_match = IMAGE_EXT_RE.search(result["flag_url"].lower())
             ext = f".{ext_match.group(1)}" if ext_match else ".png"
-            slug = slugify_prefeitura(result["name"])
+            slug = slugs[result["ibge_code"]]
             dest = RAW_FLAGS_DIR / result["uf"] / f"{result['ibge_code']}-{slug}{ext}"
 
             if dest.exists() and dest.stat().st_size > 0:
                 downloaded += 1
-                continue
-
-            ok, size_or_error = download_file(result["flag_url"], dest)
+            else:
+                jobs.append((result, result["flag_url"], dest))
+
+        # Flags sit on as many hosts as there are prefeituras; PACER still
+        # spaces out the few that share one
+        for result, (ok, size_or_error) in tqdm(
+            download_many(download_file, jobs, args.workers),
+            total=len(jobs), desc="  Downloading flags", unit="file",
+        ):
             if ok:
                 downloaded += 1
                 total_bytes += size_or_error
 
-            time.sleep(0.5)
-
         # Update database
-        found_codes = {r["ibge_code"] for r in found}
+        found_by_code = {r["ibge_code"]: r for r in found}
         for m in municipios:
-            if m["ibge_code"] in found_codes and m["flag_status"] != "found":
-                result = next(r for r in found if r["ibge_code"] == m["ibge_code"])
+            result = found_by_code.get(m["ibge_code"])
+            if result and m["flag_status"] != "found":
                 m["flag_status"] = "found"
                 m["flag_source"] = "prefeitura"
                 m["flag_url"] = result["flag_url"]
 
-        with open(db_path, "w", encoding="utf-8") as f:
-            json.dump(municipios, f, ensure_ascii=False, indent=2)
+        save_municipios(db_path, municipios)
 
         mb = total_bytes / (1024 * 1024)
         print(f"\n  💾 Downloaded {downloaded} flags ({mb:.1f} MB)")
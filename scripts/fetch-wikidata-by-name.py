@@ -3,25 +3,62 @@
 Search Wikidata for missing municipality flags by name.
 
 Instead of bulk SPARQL, this queries each municipality individually
-using the wbsearchentities API, then fetches P41 (flag image).
+using the wbsearchentities API, then fetches P41 (flag image) for all
+candidate entities at once, a batch of ids per SPARQL query.
 
 This catches municipalities that weren't found by IBGE code matching.
+
+All workers share one request budget (REQUEST_RATE per second) that backs
+off when Wikidata answers 429, so --workers raises the number of requests
+in flight without raising the load on the API beyond that rate.
+
+Search results are kept in data/wikidata-search-cache.json, so a re-run
+only searches names it has not seen before; flags are always looked up
+again. --no-cache ignores the saved results (e.g. to pick up entities
+created on Wikidata since).
+
+Usage:
+  python3 scripts/fetch-wikidata-by-name.py [--workers N] [--no-cache]
 """
 
+import argparse
 import json
 import time
+import urllib.error
 import urllib.request
 import urllib.parse
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+import http_session
+from downloader import TokenBucket, backoff_delay, retry_after
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
 WIKIDATA_API = "https://www.wikidata.org/w/api.php"
-MAX_WORKERS = 4
-REQUEST_DELAY = 0.3
+WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
+MAX_WORKERS = 8
+REQUEST_RATE = 10  # API requests per second, shared by all workers
 REQUEST_TIMEOUT = 20
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_WAIT = 5  # seconds, when a 429 carries no Retry-After
+API_RATE = TokenBucket(rate=REQUEST_RATE, capacity=MAX_WORKERS)
+SPARQL_TIMEOUT = 60
+FLAG_BATCH = 200  # entities per flag query
+SEARCH_LANGUAGE = "pt"
+
+# Search term -> [{"id", "description"}, ...]; shared by the worker threads
+search_cache = {}
+
+# P41 = flag image, best-ranked statement(s) of each listed entity
+FLAG_QUERY = """
+SELECT ?item ?flag WHERE {{
+  VALUES ?item {{ {values} }}
+  ?item wdt:P41 ?flag .
+}}
+"""
 
 UF_NAMES = {
     "RO": "Rondônia", "AC": "Acre", "AM": "Amazonas", "RR": "Roraima",
@@ -36,115 +73,149 @@ UF_NAMES = {
 }
 
 
-def search_entity(name: str, uf: str) -> list:
-    """Search Wikidata for a municipality entity."""
-    search_terms = [
-        f"{name}",
-        f"{name} {UF_NAMES.get(uf, uf)}",
-    ]
-
-    for term in search_terms:
-        params = urllib.parse.urlencode({
-            "action": "wbsearchentities",
-            "search": term,
-            "language": "pt",
-            "type": "item",
-            "limit": "10",
-            "format": "json",
-        })
-
-        url = f"{WIKIDATA_API}?{params}"
-        req = urllib.request.Request(url, headers={
-            "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
-        })
+def api_get(params: dict) -> dict:
+    """GET the Wikidata API within the shared rate; returns the JSON or None."""
+    url = f"{WIKIDATA_API}?{urllib.parse.urlencode(params)}"
+    req = urllib.request.Request(url, headers={
+        "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+        "Accept-Encoding": "gzip",
+    })
 
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        API_RATE.acquire()
         try:
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                data = json.loads(response.read().decode("utf-8"))
-                results = data.get("search", [])
-                if results:
-                    return results
+            with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                data = json.loads(http_session.read_body(response))
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                # Slows every worker down, not just this one
+                wait = retry_after(e.headers)
+                API_RATE.pause(RATE_LIMIT_WAIT if wait is None else wait)
+                continue
+            return None
         except Exception:
-            pass
+            return None
+        API_RATE.success()
+        return data
+    return None
 
-        time.sleep(REQUEST_DELAY)
 
-    return []
+def search_term(term: str) -> list:
+    """wbsearchentities results for term, from search_cache when already known.
 
+    Only successful responses are cached, so failed searches are retried on
+    the next run.
+    """
+    key = f"{SEARCH_LANGUAGE}:{term}"
+    if key in search_cache:
+        return search_cache[key]
 
-def get_entity_claims(entity_id: str) -> dict:
-    """Get claims (properties) for a Wikidata entity."""
-    params = urllib.parse.urlencode({
-        "action": "wbgetclaims",
-        "entity": entity_id,
-        "property": "P41",  # flag image
+    data = api_get({
+        "action": "wbsearchentities",
+        "search": term,
+        "language": SEARCH_LANGUAGE,
+        "type": "item",
+        "limit": "10",
         "format": "json",
     })
+    if data is None:
+        return []
+    # Only what find_candidates() looks at
+    results = [
+        {"id": r.get("id", ""), "description": r.get("description", "")}
+        for r in data.get("search", [])
+    ]
+    search_cache[key] = results
+    return results
 
-    url = f"{WIKIDATA_API}?{params}"
-    req = urllib.request.Request(url, headers={
-        "User-Agent": "BandeirasmunicipiosBR/2.0 Python/3",
-    })
 
-    try:
-        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-            data = json.loads(response.read().decode("utf-8"))
-            return data.get("claims", {})
-    except Exception:
-        return {}
-
-
-def get_flag_from_entity(entity_id: str) -> str:
-    """Get flag image filename from entity claims."""
-    claims = get_entity_claims(entity_id)
-    p41 = claims.get("P41", [])
-    if p41:
-        mainsnak = p41[0].get("mainsnak", {})
-        datavalue = mainsnak.get("datavalue", {})
-        value = datavalue.get("value")
-        if value:
-            return value
-    return None
+def search_entity(name: str, uf: str) -> list:
+    """Search Wikidata for a municipality entity."""
+    search_terms = [
+        f"{name}",
+        f"{name} {UF_NAMES.get(uf, uf)}",
+    ]
 
+    for term in search_terms:
+        results = search_term(term)
+        if results:
+            return results
 
-def process_municipality(m: dict) -> dict:
-    """Search for a municipality's flag on Wikidata by name."""
-    results = search_entity(m["name"], m["uf"])
+    return []
 
-    for result in results:
+
+def find_candidates(m: dict) -> list:
+    """Wikidata ids from the name search whose description fits this municipality."""
+    keywords = [
+        "município", "municipio", "municipality",
+        "brasil", "brazil",
+        UF_NAMES.get(m["uf"], "").lower(),
+        m["uf"].lower(),
+    ]
+    candidates = []
+    for result in search_entity(m["name"], m["uf"]):
         entity_id = result.get("id", "")
         description = result.get("description", "").lower()
 
         # Filter: should be a Brazilian municipality
-        if any(kw in description for kw in [
-            "município", "municipio", "municipality",
-            "brasil", "brazil",
-            UF_NAMES.get(m["uf"], "").lower(),
-            m["uf"].lower(),
-        ]):
-            flag_file = get_flag_from_entity(entity_id)
-            if flag_file:
-                return {
-                    "ibge_code": m["ibge_code"],
-                    "name": m["name"],
-                    "uf": m["uf"],
-                    "found": True,
-                    "wikidata_id": entity_id,
-                    "flag_file": flag_file,
-                    "flag_url": f"https://commons.wikimedia.org/wiki/Special:FilePath/{urllib.parse.quote(flag_file)}",
-                }
-
-            time.sleep(REQUEST_DELAY)
-
-    return {
-        "ibge_code": m["ibge_code"],
-        "name": m["name"],
-        "uf": m["uf"],
-        "found": False,
-    }
+        if entity_id and any(kw in description for kw in keywords):
+            candidates.append(entity_id)
+    return candidates
+
+
+def sparql_query(query: str) -> list:
+    """Run a SPARQL query, retrying on errors; returns the result bindings."""
+    req = urllib.request.Request(
+        f"{WIKIDATA_SPARQL_URL}?{urllib.parse.urlencode({'query': query, 'format': 'json'})}",
+        headers={
+            "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+            "Accept": "application/sparql-results+json",
+            "Accept-Encoding": "gzip",
+        },
+    )
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            with http_session.urlopen(req, timeout=SPARQL_TIMEOUT) as response:
+                data = json.loads(http_session.read_body(response))
+            return data.get("results", {}).get("bindings", [])
+        except Exception as e:
+            if attempt == RATE_LIMIT_RETRIES:
+                print(f"  ❌ SPARQL query failed: {e}")
+                return []
+            wait = retry_after(e.headers) if isinstance(e, urllib.error.HTTPError) else None
+            time.sleep(backoff_delay(attempt, RATE_LIMIT_WAIT) if wait is None else wait)
+
+
+def get_flags(entity_ids: list) -> dict:
+    """Map entity id -> flag image filename (P41) for those that have one.
+
+    One SPARQL query answers FLAG_BATCH entities, instead of a wbgetclaims
+    call per entity.
+    """
+    flags = {}
+    batches = range(0, len(entity_ids), FLAG_BATCH)
+    for start in tqdm(batches, desc="  Fetching flags", unit="batch"):
+        values = " ".join(f"wd:{entity_id}" for entity_id in entity_ids[start:start + FLAG_BATCH])
+        for row in sparql_query(FLAG_QUERY.format(values=values)):
+            entity_id = row["item"]["value"].rsplit("/", 1)[-1]
+            # Special:FilePath URL -> filename, as wbgetclaims would return it
+            flag_file = urllib.parse.unquote(row["flag"]["value"].rsplit("/", 1)[-1])
+            flags.setdefault(entity_id, flag_file)
+    return flags
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Search Wikidata for missing flags by name")
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS,
+        help=f"Number of municipalities searched in parallel (default: {MAX_WORKERS})"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Ignore saved search results and search every name again"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 WIKIDATA NAME SEARCH")
     print("=" * 60)
@@ -162,43 +233,73 @@ def main():
         print("  All flags already found!")
         return
 
+    cache_path = DATA_DIR / "wikidata-search-cache.json"
+    if cache_path.exists() and not args.no_cache:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            search_cache.update(json.load(f))
+        print(f"  🗂️  {len(search_cache)} cached search results")
+
     # Search Wikidata
     print(f"\n  Searching Wikidata by name...")
+    candidates = {}  # ibge_code -> candidate entity ids, best first
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(find_candidates, m): m for m in missing}
+
+            with tqdm(total=len(missing), desc="  Searching Wikidata", unit="mun") as pbar:
+                for future in as_completed(futures):
+                    candidates[futures[future]["ibge_code"]] = future.result()
+                    pbar.update(1)
+    finally:
+        # Keep what was searched even if the run is interrupted
+        save_json(cache_path, search_cache)
+
+    # Look up flags for every candidate in batches
+    entity_ids = sorted({e for ids in candidates.values() for e in ids})
+    print(f"\n  Looking up flags for {len(entity_ids)} candidate entities...")
+    flags = get_flags(entity_ids)
+
+    # First candidate with a flag wins, as when claims were fetched one by one
     found = []
     not_found = []
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_municipality, m): m for m in missing}
-
-        with tqdm(total=len(missing), desc="  Searching Wikidata", unit="mun") as pbar:
-            for future in as_completed(futures):
-                result = future.result()
-                if result["found"]:
-                    found.append(result)
-                else:
-                    not_found.append(result)
-                pbar.update(1)
-                pbar.set_postfix(found=len(found), miss=len(not_found))
+    for m in missing:
+        entity_id = next((e for e in candidates[m["ibge_code"]] if e in flags), None)
+        if entity_id:
+            found.append({
+                "ibge_code": m["ibge_code"],
+                "name": m["name"],
+                "uf": m["uf"],
+                "found": True,
+                "wikidata_id": entity_id,
+                "flag_file": flags[entity_id],
+                "flag_url": f"https://commons.wikimedia.org/wiki/Special:FilePath/{urllib.parse.quote(flags[entity_id])}",
+            })
+        else:
+            not_found.append({
+                "ibge_code": m["ibge_code"],
+                "name": m["name"],
+                "uf": m["uf"],
+                "found": False,
+            })
 
     # Save results
     results_path = DATA_DIR / "wikidata-name-search.json"
-    with open(results_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    save_json(results_path, {"found": found, "not_found": not_found})
 
     # Update database
     if found:
-        found_codes = {r["ibge_code"] for r in found}
+        found_by_code = {r["ibge_code"]: r for r in found}
         for m in municipios:
-            if m["ibge_code"] in found_codes and m["flag_status"] != "found":
-                result = next(r for r in found if r["ibge_code"] == m["ibge_code"])
+            result = found_by_code.get(m["ibge_code"])
+            if result and m["flag_status"] != "found":
                 m["flag_status"] = "found"
                 m["flag_source"] = "wikidata-name"
                 m["flag_url"] = result["flag_url"]
                 m["flag_file"] = result["flag_file"]
                 m["wikidata_id"] = result["wikidata_id"]
 
-        with open(db_path, "w", encoding="utf-8") as f:
-            json.dump(municipios, f, ensure_ascii=False, indent=2)
+        save_municipios(db_path, municipios)
 
     # Summary
     total_found = sum(1 for m in municipios if m["flag_status"] == "found")
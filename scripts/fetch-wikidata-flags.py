@@ -19,6 +19,9 @@ import urllib.parse
 from pathlib import Path
 from tqdm import tqdm
 
+import http_session
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
 WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
@@ -27,13 +30,17 @@ WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
 # P31 = instance of, Q3184121 = municipality of Brazil
 # P41 = flag image
 # P1585 = Brazilian IBGE municipality code
+# Labels (pt, else en) come from plain rdfs:label joins; the
+# wikibase:label SERVICE does the same but is far slower on large results
 SPARQL_QUERY = """
 SELECT ?municipality ?municipalityLabel ?ibgeCode ?flagImage ?coords WHERE {
   ?municipality wdt:P31/wdt:P279* wd:Q3184121 .
   OPTIONAL { ?municipality wdt:P1585 ?ibgeCode . }
   OPTIONAL { ?municipality wdt:P41 ?flagImage . }
   OPTIONAL { ?municipality wdt:P625 ?coords . }
-  SERVICE wikibase:label { bd:serviceParam wikibase:language "pt,en" . }
+  OPTIONAL { ?municipality rdfs:label ?ptLabel . FILTER(LANG(?ptLabel) = "pt") }
+  OPTIONAL { ?municipality rdfs:label ?enLabel . FILTER(LANG(?enLabel) = "en") }
+  BIND(COALESCE(?ptLabel, ?enLabel) AS ?municipalityLabel)
 }
 """
 
@@ -50,7 +57,9 @@ SELECT ?municipality ?municipalityLabel ?ibgeCode ?flagImage WHERE {
   ?municipality wdt:P17 wd:Q155 .
   OPTIONAL { ?municipality wdt:P1585 ?ibgeCode . }
   OPTIONAL { ?municipality wdt:P41 ?flagImage . }
-  SERVICE wikibase:label { bd:serviceParam wikibase:language "pt,en" . }
+  OPTIONAL { ?municipality rdfs:label ?ptLabel . FILTER(LANG(?ptLabel) = "pt") }
+  OPTIONAL { ?municipality rdfs:label ?enLabel . FILTER(LANG(?enLabel) = "en") }
+  BIND(COALESCE(?ptLabel, ?enLabel) AS ?municipalityLabel)
 }
 """
 
@@ -68,12 +77,12 @@ def query_wikidata(query: str, description: str) -> list:
     req = urllib.request.Request(url, headers={
         "User-Agent": "BandeirasmunicipiosBR/1.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
         "Accept": "application/sparql-results+json",
+        "Accept-Encoding": "gzip",
     })
 
     try:
-        with urllib.request.urlopen(req, timeout=120) as response:
-            raw = response.read()
-            data = json.loads(raw.decode("utf-8"))
+        with http_session.urlopen(req, timeout=120) as response:
+            data = json.loads(http_session.read_body(response))
             results = data.get("results", {}).get("bindings", [])
             print(f"  ✅ Got {len(results)} results")
             return results
@@ -145,8 +154,7 @@ def main():
 
     # Save raw results
     raw_path = DATA_DIR / "wikidata-flags-raw.json"
-    with open(raw_path, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    save_json(raw_path, results)
     print(f"\n  💾 Saved raw results to {raw_path}")
 
     # Parse results
@@ -157,6 +165,7 @@ def main():
     matched_ibge = 0
     matched_name = 0
     flags_total = 0
+    updated = 0
     unmatched = []
 
     print("\n  Step 3/3: Matching with IBGE database...")
@@ -177,19 +186,25 @@ def main():
             matched_ibge += 1
 
         # Update municipality record
-        m["wikidata_id"] = entry.get("wikidata_id")
+        fields = {"wikidata_id": entry.get("wikidata_id")}
 
         if entry.get("flag_url"):
-            m["flag_status"] = "found"
-            m["flag_source"] = "wikidata"
-            m["flag_url"] = entry["flag_url"]
-            m["flag_file"] = commons_url_to_filename(entry["flag_url"])
+            fields["flag_status"] = "found"
+            fields["flag_source"] = "wikidata"
+            fields["flag_url"] = entry["flag_url"]
+            fields["flag_file"] = commons_url_to_filename(entry["flag_url"])
             flags_total += 1
 
-    # Save updated database
-    with open(db_path, "w", encoding="utf-8") as f:
-        json.dump(municipios, f, ensure_ascii=False, indent=2)
-    print(f"\n  💾 Updated database at {db_path}")
+        if any(k not in m or m[k] != v for k, v in fields.items()):
+            m.update(fields)
+            updated += 1
+
+    # Save updated database (a re-run against unchanged Wikidata data changes nothing)
+    if updated:
+        save_municipios(db_path, municipios)
+        print(f"\n  💾 Updated {updated} records in {db_path}")
+    else:
+        print(f"\n  💾 No changes to {db_path}")
 
     # Save Wikidata match index
     wikidata_index = {
@@ -200,13 +215,11 @@ def main():
         "flags_found": flags_total,
     }
     index_path = DATA_DIR / "wikidata-index.json"
-    with open(index_path, "w", encoding="utf-8") as f:
-        json.dump(wikidata_index, f, ensure_ascii=False, indent=2)
+    save_json(index_path, wikidata_index)
 
     # Save unmatched for manual review
     unmatched_path = DATA_DIR / "unmatched-municipalities.json"
-    with open(unmatched_path, "w", encoding="utf-8") as f:
-        json.dump(sorted(unmatched, key=lambda x: x["name"]), f, ensure_ascii=False, indent=2)
+    save_json(unmatched_path, sorted(unmatched, key=lambda x: x["name"]))
 
     # Print summary
     total = len(municipios)
@@ -7,46 +7,45 @@ Key improvements over v1:
 - Validates that the flag filename contains the municipality name
 - Uses Wikipedia API parse action to get infobox image directly
 - Falls back to image list search
+
+The image lists of all candidate articles are requested up front, 50
+titles per API call, and each municipality is then matched offline.
 """
 
+import functools
+import hashlib
 import json
-import time
 import re
+import time
 import unicodedata
 import urllib.request
 import urllib.parse
 import urllib.error
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+import http_session
+from brazil_states import STATE_FLAG_NAMES, UF_NAMES
+from downloader import (
+    TokenBucket, backoff_delay, download_many, pause_all, retry_after, save_response,
+    wait_if_paused,
+)
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 WIKIPEDIA_API = "https://pt.wikipedia.org/w/api.php"
 MAX_WORKERS = 4
-REQUEST_DELAY = 0.5
+REQUEST_DELAY = 0.5  # seconds between requests, per worker
+# API requests of all workers together, backed off on 429
+API_RATE = TokenBucket(rate=MAX_WORKERS / REQUEST_DELAY, capacity=MAX_WORKERS)
 REQUEST_TIMEOUT = 20
-
-UF_NAMES = {
-    "RO": "Rondônia", "AC": "Acre", "AM": "Amazonas", "RR": "Roraima",
-    "PA": "Pará", "AP": "Amapá", "TO": "Tocantins", "MA": "Maranhão",
-    "PI": "Piauí", "CE": "Ceará", "RN": "Rio Grande do Norte",
-    "PB": "Paraíba", "PE": "Pernambuco", "AL": "Alagoas", "SE": "Sergipe",
-    "BA": "Bahia", "MG": "Minas Gerais", "ES": "Espírito Santo",
-    "RJ": "Rio de Janeiro", "SP": "São Paulo", "PR": "Paraná",
-    "SC": "Santa Catarina", "RS": "Rio Grande do Sul",
-    "MS": "Mato Grosso do Sul", "MT": "Mato Grosso", "GO": "Goiás",
-    "DF": "Distrito Federal",
-}
-
-# State flag filenames to EXCLUDE
-STATE_FLAG_NAMES = set()
-for uf, name in UF_NAMES.items():
-    STATE_FLAG_NAMES.add(f"bandeira de {name.lower()}")
-    STATE_FLAG_NAMES.add(f"bandeira do {name.lower()}")
-    STATE_FLAG_NAMES.add(f"bandeira da {name.lower()}")
-    STATE_FLAG_NAMES.add(f"flag of {name.lower()}")
+RETRY_COUNT = 3  # attempts per API call or download when rate limited
+DOWNLOAD_DELAY = 0.3  # seconds each download worker waits between files
+TITLE_BATCH = 50  # most titles the API accepts in one query
+IMAGES_PER_ARTICLE = 50  # images considered per article
 
 # Generic flags to exclude
 EXCLUDE_FILENAMES = {
@@ -66,37 +65,56 @@ EXCLUDE_KEYWORDS = [
 ]
 
 
+@functools.lru_cache(maxsize=None)
 def normalize_text(text: str) -> str:
     """Remove accents and lowercase."""
+    if text.isascii():
+        # Nothing to decompose or drop
+        return text.lower().strip()
     text = unicodedata.normalize("NFKD", text)
     text = text.encode("ascii", "ignore").decode("ascii")
     return text.lower().strip()
 
 
+# Normalized once here rather than for every image checked, and matched in
+# one pass over the filename instead of a substring test per entry
+STATE_FLAGS_RE = re.compile("|".join(
+    re.escape(normalize_text(name)) for name in sorted(STATE_FLAG_NAMES)
+))
+EXCLUDE_FILENAMES_RE = re.compile("|".join(
+    re.escape(normalize_text(name)) for name in sorted(EXCLUDE_FILENAMES)
+))
+EXCLUDE_KEYWORDS_RE = re.compile("|".join(map(re.escape, EXCLUDE_KEYWORDS)))
+
+# Namespace prefixes of image titles returned by pt.wikipedia
+FILE_PREFIX_RE = re.compile(r"^(File:|Ficheiro:|Arquivo:)")
+# Characters dropped from municipality names in downloaded file names
+SLUG_STRIP_RE = re.compile(r"[^a-z0-9-]")
+
+
 def is_valid_municipality_flag(img_title: str, municipality_name: str, uf: str) -> bool:
     """Check if an image is likely the actual municipality flag."""
-    img_lower = img_title.lower()
     img_normalized = normalize_text(img_title)
-    mun_normalized = normalize_text(municipality_name)
+
+    # Must contain "bandeira" or "flag"; checked first since most images
+    # of an article (maps, photos, coats of arms) fail it
+    if "bandeira" not in img_normalized and "flag" not in img_normalized:
+        return False
 
     # Reject excluded keywords
-    if any(kw in img_normalized for kw in EXCLUDE_KEYWORDS):
+    if EXCLUDE_KEYWORDS_RE.search(img_normalized):
         return False
 
     # Reject state flags
-    for state_name in STATE_FLAG_NAMES:
-        if normalize_text(state_name) in img_normalized:
-            return False
+    if STATE_FLAGS_RE.search(img_normalized):
+        return False
 
     # Reject generic/national flags
-    for excl in EXCLUDE_FILENAMES:
-        if normalize_text(excl) in img_normalized:
-            return False
-
-    # Must contain "bandeira" or "flag"
-    if not any(kw in img_normalized for kw in ["bandeira", "flag"]):
+    if EXCLUDE_FILENAMES_RE.search(img_normalized):
         return False
 
+    mun_normalized = normalize_text(municipality_name)
+
     # Must contain part of the municipality name (at least first word, 4+ chars)
     mun_words = [w for w in mun_normalized.split() if len(w) >= 4]
     name_match = any(w in img_normalized for w in mun_words) if mun_words else False
@@ -119,50 +137,97 @@ def build_article_titles(name: str, uf: str) -> list:
     ]
 
 
-def get_article_images(title: str) -> list:
-    """Query Wikipedia API for images in an article."""
-    params = urllib.parse.urlencode({
-        "action": "query",
-        "titles": title,
-        "prop": "images",
-        "imlimit": "50",
-        "format": "json",
-    })
-
-    url = f"{WIKIPEDIA_API}?{params}"
+def api_get(params: dict) -> dict:
+    """GET the Wikipedia API, retrying when rate limited; returns the JSON or None."""
+    url = f"{WIKIPEDIA_API}?{urllib.parse.urlencode(params)}"
     req = urllib.request.Request(url, headers={
         "User-Agent": "BandeirasmunicipiosBR/2.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+        "Accept-Encoding": "gzip",
     })
 
-    try:
-        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-            data = json.loads(response.read().decode("utf-8"))
-            pages = data.get("query", {}).get("pages", {})
-            for page_id, page_data in pages.items():
-                if page_id == "-1":
-                    continue
-                images = page_data.get("images", [])
-                return [img["title"] for img in images]
-    except Exception:
-        pass
-    return []
+    for attempt in range(RETRY_COUNT):
+        API_RATE.acquire()
+        try:
+            with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                data = json.loads(http_session.read_body(response))
+            API_RATE.success()
+            return data
+        except urllib.error.HTTPError as e:
+            # Rate limited: wait and retry instead of reporting "no images"
+            if e.code not in (429, 503) or attempt == RETRY_COUNT - 1:
+                return None
+            delay = retry_after(e.headers)
+            API_RATE.pause(REQUEST_DELAY * 2 ** (attempt + 1) if delay is None else delay)
+        except Exception:
+            return None
+    return None
+
+
+def get_images_by_title(titles: list) -> dict:
+    """Query Wikipedia for the images in up to TITLE_BATCH articles at once.
+
+    Returns {title: [image titles]} for the titles that exist, each list cut
+    to IMAGES_PER_ARTICLE as when articles were queried one by one. The
+    image limit applies to the whole query, so the API may need several
+    continuation requests to list every article's images.
+    """
+    params = {
+        "action": "query",
+        "titles": "|".join(titles),
+        "prop": "images",
+        "imlimit": "max",
+        "format": "json",
+        "formatversion": "2",
+    }
+    images = {}
+    # The API answers with normalized titles (e.g. first letter capitalized)
+    normalized = {}
+
+    while True:
+        data = api_get(params)
+        if data is None:
+            break
+        query = data.get("query", {})
+        for n in query.get("normalized", []):
+            normalized[n["from"]] = n["to"]
+        for page in query.get("pages", []):
+            if page.get("missing") or page.get("invalid"):
+                continue
+            page_images = images.setdefault(page["title"], [])
+            page_images.extend(img["title"] for img in page.get("images", []))
+        if "continue" not in data:
+            break
+        params = {**params, **data["continue"]}
+
+    result = {}
+    for title in titles:
+        page_images = images.get(normalized.get(title, title))
+        if page_images:
+            result[title] = page_images[:IMAGES_PER_ARTICLE]
+    return result
 
 
 def get_commons_url(file_title: str) -> str:
     """Build Wikimedia Commons URL from a File: title."""
-    import hashlib
-    filename = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", file_title)
-    filename = filename.replace(" ", "_")
-    md5 = hashlib.md5(filename.encode("utf-8")).hexdigest()
-    return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[0:2]}/{urllib.parse.quote(filename)}"
+    # Strip the "File:"/"Ficheiro:" prefix; the UTF-8 name feeds both the
+    # hash path and the quoted URL
+    name = FILE_PREFIX_RE.sub("", file_title).replace(" ", "_").encode("utf-8")
+    md5 = hashlib.md5(name).hexdigest()
+    return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[:2]}/{urllib.parse.quote_from_bytes(name)}"
+
 
+def flag_path(result: dict) -> str:
+    """Path of a found flag under raw-flags/."""
+    slug = SLUG_STRIP_RE.sub("", result["name"].lower().replace(" ", "-"))
+    return f"{result['uf']}/{result['ibge_code']}-{slug}{Path(result['flag_filename']).suffix.lower()}"
 
-def process_municipality(m: dict) -> dict:
-    """Process a single municipality - find its flag on Wikipedia."""
+
+def process_municipality(m: dict, images_by_title: dict) -> dict:
+    """Pick a municipality's flag from the images of its candidate articles."""
     titles = build_article_titles(m["name"], m["uf"])
 
     for title in titles:
-        images = get_article_images(title)
+        images = images_by_title.get(title)
         if not images:
             continue
 
@@ -176,7 +241,7 @@ def process_municipality(m: dict) -> dict:
             # Prefer SVG
             svg = [c for c in candidates if c.lower().endswith(".svg")]
             best = svg[0] if svg else candidates[0]
-            filename = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", best)
+            filename = FILE_PREFIX_RE.sub("", best)
 
             return {
                 "ibge_code": m["ibge_code"],
@@ -189,8 +254,6 @@ def process_municipality(m: dict) -> dict:
                 "wikipedia_title": title,
             }
 
-        time.sleep(REQUEST_DELAY)
-
     return {
         "ibge_code": m["ibge_code"],
         "name": m["name"],
@@ -199,22 +262,37 @@ def process_municipality(m: dict) -> dict:
     }
 
 
-def download_file(url: str, dest: Path) -> tuple:
-    """Download a file. Returns (success, size_or_error)."""
-    try:
-        req = urllib.request.Request(url, headers={
-            "User-Agent": "BandeirasmunicipiosBR/2.0 Python/3",
-        })
-        with urllib.request.urlopen(req, timeout=30) as response:
-            data = response.read()
-            if len(data) < 100:
+def download_file(url: str, dest: Path, retries: int = RETRY_COUNT) -> tuple:
+    """Download a file with retries. Returns (success, size_or_error).
+
+    upload.wikimedia.org throttles bulk clients: a 429/503 with Retry-After
+    pauses every download worker, other failures are retried with backoff.
+    """
+    for attempt in range(retries):
+        wait_if_paused()
+        try:
+            req = urllib.request.Request(url, headers={
+                "User-Agent": "BandeirasmunicipiosBR/2.0 Python/3",
+            })
+            with http_session.urlopen(req, timeout=30) as response:
+                size = save_response(response, dest)
+            if size < 100:
+                dest.unlink()
                 return (False, "File too small")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                f.write(data)
-            return (True, len(data))
-    except Exception as e:
-        return (False, str(e))
+            return (True, size)
+        except urllib.error.HTTPError as e:
+            if e.code == 404 or attempt == retries - 1:
+                return (False, f"HTTP {e.code}: {e.reason}")
+            delay = retry_after(e.headers) if e.code in (429, 503) else None
+            if delay is not None:
+                pause_all(delay)
+            else:
+                time.sleep(backoff_delay(attempt, REQUEST_DELAY))
+        except Exception as e:
+            if attempt == retries - 1:
+                return (False, str(e))
+            time.sleep(backoff_delay(attempt, REQUEST_DELAY))
+    return (False, "Max retries exceeded")
 
 
 def main():
@@ -240,23 +318,31 @@ def main():
     found = []
     not_found = []
 
+    # Every candidate article title, queried TITLE_BATCH at a time
+    titles = list(dict.fromkeys(
+        title for m in missing for title in build_article_titles(m["name"], m["uf"])
+    ))
+    batches = [titles[i:i + TITLE_BATCH] for i in range(0, len(titles), TITLE_BATCH)]
+    images_by_title = {}
+
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_municipality, m): m for m in missing}
-
-        with tqdm(total=len(missing), desc="  Searching Wikipedia", unit="mun") as pbar:
-            for future in as_completed(futures):
-                result = future.result()
-                if result["found"]:
-                    found.append(result)
-                else:
-                    not_found.append(result)
-                pbar.update(1)
-                pbar.set_postfix(found=len(found), missing=len(not_found))
+        futures = [executor.submit(get_images_by_title, batch) for batch in batches]
+
+        with tqdm(total=len(titles), desc="  Searching Wikipedia", unit="title") as pbar:
+            for future, batch in zip(futures, batches):
+                images_by_title.update(future.result())
+                pbar.update(len(batch))
+
+    for m in missing:
+        result = process_municipality(m, images_by_title)
+        if result["found"]:
+            found.append(result)
+        else:
+            not_found.append(result)
 
     # Save results
     wiki_results_path = DATA_DIR / "wikipedia-flags-v2.json"
-    with open(wiki_results_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    save_json(wiki_results_path, {"found": found, "not_found": not_found})
     print(f"\n  💾 Saved results to {wiki_results_path}")
 
     # Show what was found
@@ -274,36 +360,33 @@ def main():
         errors = []
         total_bytes = 0
 
-        for result in tqdm(found, desc="  Downloading flags", unit="file"):
-            ext = Path(result["flag_filename"]).suffix.lower()
-            slug = re.sub(r"[^a-z0-9-]", "", result["name"].lower().replace(" ", "-"))
-            dest = RAW_FLAGS_DIR / result["uf"] / f"{result['ibge_code']}-{slug}{ext}"
-
+        jobs = []
+        for result in found:
+            dest = RAW_FLAGS_DIR / flag_path(result)
             if dest.exists() and dest.stat().st_size > 0:
                 downloaded += 1
-                continue
+            else:
+                jobs.append((result, result["flag_url"], dest))
 
-            ok, size_or_error = download_file(result["flag_url"], dest)
+        for result, (ok, size_or_error) in tqdm(download_many(download_file, jobs, MAX_WORKERS, DOWNLOAD_DELAY),
+                                                total=len(jobs), desc="  Downloading flags", unit="file"):
             if ok:
                 downloaded += 1
                 total_bytes += size_or_error
             else:
                 errors.append({**result, "error": size_or_error})
 
-            time.sleep(0.3)
-
         # Update database
-        found_codes = {r["ibge_code"] for r in found}
+        found_by_code = {r["ibge_code"]: r for r in found}
         for m in municipios:
-            if m["ibge_code"] in found_codes and m["flag_status"] != "found":
-                result = next(r for r in found if r["ibge_code"] == m["ibge_code"])
+            result = found_by_code.get(m["ibge_code"])
+            if result and m["flag_status"] != "found":
                 m["flag_status"] = "found"
                 m["flag_source"] = "wikipedia-v2"
                 m["flag_url"] = result["flag_url"]
                 m["flag_file"] = result["flag_filename"]
 
-        with open(db_path, "w", encoding="utf-8") as f:
-            json.dump(municipios, f, ensure_ascii=False, indent=2)
+        save_municipios(db_path, municipios)
 
         mb = total_bytes / (1024 * 1024)
         print(f"\n  💾 Downloaded {downloaded} flags ({mb:.1f} MB)")
@@ -11,26 +11,54 @@ Strategy:
 3. Download from Wikimedia Commons
 
 This targets the ~1,775 municipalities NOT found via Wikidata.
+
+Article image lists are appended to data/wikipedia-images-cache.ndjson
+as each query answers, so a re-run, even after a crash, only queries
+titles it has not seen before. --no-cache starts that file over (e.g.
+after articles were edited).
+
+Usage:
+  python3 scripts/fetch-wikipedia-flags.py [--no-cache]
 """
 
+import argparse
 import json
-import time
 import urllib.request
 import urllib.parse
 import urllib.error
 import hashlib
 import re
+import time
+import threading
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+import http_session
+from brazil_states import UF_NAMES
+from downloader import (
+    TokenBucket, backoff_delay, download_many, map_unordered, pause_all, retry_after,
+    save_response, wait_if_paused,
+)
+from municipios_db import save_json, save_municipios
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
 WIKIPEDIA_API = "https://pt.wikipedia.org/w/api.php"
 MAX_WORKERS = 4  # Be gentle with Wikipedia
-REQUEST_DELAY = 0.5  # seconds between requests
+REQUEST_DELAY = 0.5  # seconds between requests, per worker
+# API requests of all workers together, backed off on 429
+API_RATE = TokenBucket(rate=MAX_WORKERS / REQUEST_DELAY, capacity=MAX_WORKERS)
 REQUEST_TIMEOUT = 20
+RETRY_COUNT = 3  # attempts per API call or download when rate limited
+DOWNLOAD_DELAY = 0.3  # seconds each download worker waits between files
+
+# Article title -> image titles (empty for missing articles); shared by the
+# worker threads
+image_cache = {}
+# Open cache file that new entries are appended to, one [title, images] per line
+cache_file = None
+cache_lock = threading.Lock()
 
 # Keywords that indicate a flag image
 FLAG_KEYWORDS = [
@@ -44,17 +72,12 @@ EXCLUDE_KEYWORDS = [
     "hino", "logo", "escudo", "shield", "panorama", "vista",
 ]
 
-UF_NAMES = {
-    "RO": "Rondônia", "AC": "Acre", "AM": "Amazonas", "RR": "Roraima",
-    "PA": "Pará", "AP": "Amapá", "TO": "Tocantins", "MA": "Maranhão",
-    "PI": "Piauí", "CE": "Ceará", "RN": "Rio Grande do Norte",
-    "PB": "Paraíba", "PE": "Pernambuco", "AL": "Alagoas", "SE": "Sergipe",
-    "BA": "Bahia", "MG": "Minas Gerais", "ES": "Espírito Santo",
-    "RJ": "Rio de Janeiro", "SP": "São Paulo", "PR": "Paraná",
-    "SC": "Santa Catarina", "RS": "Rio Grande do Sul",
-    "MS": "Mato Grosso do Sul", "MT": "Mato Grosso", "GO": "Goiás",
-    "DF": "Distrito Federal",
-}
+# One pass over the image title instead of a substring test per keyword
+FLAG_KEYWORDS_RE = re.compile("|".join(map(re.escape, FLAG_KEYWORDS)))
+EXCLUDE_KEYWORDS_RE = re.compile("|".join(map(re.escape, EXCLUDE_KEYWORDS)))
+
+# Namespace prefixes of image titles returned by pt.wikipedia
+FILE_PREFIX_RE = re.compile(r"^(File:|Ficheiro:|Arquivo:)")
 
 
 def build_article_titles(name: str, uf: str) -> list:
@@ -68,7 +91,14 @@ def build_article_titles(name: str, uf: str) -> list:
 
 
 def get_article_images(title: str) -> list:
-    """Query Wikipedia API for images in an article."""
+    """Query Wikipedia API for images in an article.
+
+    Answers are remembered in image_cache; failed requests are not, so they
+    are retried on the next run.
+    """
+    if title in image_cache:
+        return image_cache[title]
+
     params = urllib.parse.urlencode({
         "action": "query",
         "titles": title,
@@ -80,19 +110,38 @@ def get_article_images(title: str) -> list:
     url = f"{WIKIPEDIA_API}?{params}"
     req = urllib.request.Request(url, headers={
         "User-Agent": "BandeirasmunicipiosBR/1.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+        "Accept-Encoding": "gzip",
     })
 
-    try:
-        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-            data = json.loads(response.read().decode("utf-8"))
-            pages = data.get("query", {}).get("pages", {})
-            for page_id, page_data in pages.items():
-                if page_id == "-1":
-                    continue
-                images = page_data.get("images", [])
-                return [img["title"] for img in images]
-    except Exception:
-        pass
+    for attempt in range(RETRY_COUNT):
+        API_RATE.acquire()
+        try:
+            with http_session.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                data = json.loads(http_session.read_body(response))
+            API_RATE.success()
+        except urllib.error.HTTPError as e:
+            # Rate limited: wait and retry instead of reporting "no images"
+            if e.code not in (429, 503) or attempt == RETRY_COUNT - 1:
+                return []
+            delay = retry_after(e.headers)
+            API_RATE.pause(REQUEST_DELAY * 2 ** (attempt + 1) if delay is None else delay)
+            continue
+        except Exception:
+            return []
+        images = []
+        pages = data.get("query", {}).get("pages", {})
+        for page_id, page_data in pages.items():
+            if page_id == "-1":
+                continue
+            images = [img["title"] for img in page_data.get("images", [])]
+            break
+        image_cache[title] = images
+        if cache_file is not None:
+            with cache_lock:
+                cache_file.write(json.dumps([title, images], ensure_ascii=False) + "\n")
+                # Flushed per entry so a killed run still keeps its answers
+                cache_file.flush()
+        return images
     return []
 
 
@@ -103,11 +152,11 @@ def find_flag_image(images: list) -> str:
         img_lower = img_title.lower()
 
         # Skip excluded images
-        if any(kw in img_lower for kw in EXCLUDE_KEYWORDS):
+        if EXCLUDE_KEYWORDS_RE.search(img_lower):
             continue
 
         # Check for flag keywords
-        if any(kw in img_lower for kw in FLAG_KEYWORDS):
+        if FLAG_KEYWORDS_RE.search(img_lower):
             candidates.append(img_title)
 
     if candidates:
@@ -122,11 +171,11 @@ def find_flag_image(images: list) -> str:
 
 def get_commons_url(file_title: str) -> str:
     """Build Wikimedia Commons URL from a File: title."""
-    # Remove "File:" or "Ficheiro:" prefix
-    filename = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", file_title)
-    filename = filename.replace(" ", "_")
-    md5 = hashlib.md5(filename.encode("utf-8")).hexdigest()
-    return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[0:2]}/{urllib.parse.quote(filename)}"
+    # Strip the "File:"/"Ficheiro:" prefix; the UTF-8 name feeds both the
+    # hash path and the quoted URL
+    name = FILE_PREFIX_RE.sub("", file_title).replace(" ", "_").encode("utf-8")
+    md5 = hashlib.md5(name).hexdigest()
+    return f"https://upload.wikimedia.org/wikipedia/commons/{md5[0]}/{md5[:2]}/{urllib.parse.quote_from_bytes(name)}"
 
 
 def get_file_extension(filename: str) -> str:
@@ -134,6 +183,12 @@ def get_file_extension(filename: str) -> str:
     return Path(filename).suffix.lower()
 
 
+def flag_path(result: dict) -> str:
+    """Path of a found flag under raw-flags/, shared by the download and the DB update."""
+    slug = result["name"].lower().replace(" ", "-")
+    return f"{result['uf']}/{result['ibge_code']}-{slug}{get_file_extension(result['flag_filename'])}"
+
+
 def process_municipality(m: dict) -> dict:
     """Process a single municipality - find its flag on Wikipedia."""
     titles = build_article_titles(m["name"], m["uf"])
@@ -145,7 +200,7 @@ def process_municipality(m: dict) -> dict:
 
         flag_title = find_flag_image(images)
         if flag_title:
-            filename = re.sub(r"^(File:|Ficheiro:|Arquivo:)", "", flag_title)
+            filename = FILE_PREFIX_RE.sub("", flag_title)
             return {
                 "ibge_code": m["ibge_code"],
                 "name": m["name"],
@@ -157,8 +212,6 @@ def process_municipality(m: dict) -> dict:
                 "wikipedia_title": title,
             }
 
-        time.sleep(REQUEST_DELAY)
-
     return {
         "ibge_code": m["ibge_code"],
         "name": m["name"],
@@ -167,23 +220,63 @@ def process_municipality(m: dict) -> dict:
     }
 
 
-def download_file(url: str, dest: Path) -> tuple:
-    """Download a file. Returns (success, size_or_error)."""
-    try:
-        req = urllib.request.Request(url, headers={
-            "User-Agent": "BandeirasmunicipiosBR/1.0 Python/3",
-        })
-        with urllib.request.urlopen(req, timeout=30) as response:
-            data = response.read()
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                f.write(data)
-            return (True, len(data))
-    except Exception as e:
-        return (False, str(e))
+def download_file(url: str, dest: Path, retries: int = RETRY_COUNT) -> tuple:
+    """Download a file with retries. Returns (success, size_or_error).
+
+    upload.wikimedia.org throttles bulk clients: a 429/503 with Retry-After
+    pauses every download worker, other failures are retried with backoff.
+    """
+    for attempt in range(retries):
+        wait_if_paused()
+        try:
+            req = urllib.request.Request(url, headers={
+                "User-Agent": "BandeirasmunicipiosBR/1.0 Python/3",
+            })
+            with http_session.urlopen(req, timeout=30) as response:
+                return (True, save_response(response, dest))
+        except urllib.error.HTTPError as e:
+            if e.code == 404 or attempt == retries - 1:
+                return (False, f"HTTP {e.code}: {e.reason}")
+            delay = retry_after(e.headers) if e.code in (429, 503) else None
+            if delay is not None:
+                pause_all(delay)
+            else:
+                time.sleep(backoff_delay(attempt, REQUEST_DELAY))
+        except Exception as e:
+            if attempt == retries - 1:
+                return (False, str(e))
+            time.sleep(backoff_delay(attempt, REQUEST_DELAY))
+    return (False, "Max retries exceeded")
+
+
+def load_image_cache(path: Path) -> bool:
+    """Fill image_cache from the NDJSON cache file, if there is one.
+
+    Returns True when the file ends in a line cut short by a killed run,
+    which new entries must not be appended to.
+    """
+    if not path.exists():
+        return False
+    line = "\n"
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                title, images = json.loads(line)
+            except ValueError:
+                continue
+            image_cache[title] = images
+    return not line.endswith("\n")
 
 
 def main():
+    global cache_file
+    parser = argparse.ArgumentParser(description="Fetch missing flags from Portuguese Wikipedia")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Ignore saved article image lists and query every title again"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("  🇧🇷 WIKIPEDIA FLAG FINDER")
     print("=" * 60)
@@ -206,23 +299,29 @@ def main():
     found = []
     not_found = []
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_municipality, m): m for m in missing}
+    cache_path = DATA_DIR / "wikipedia-images-cache.ndjson"
+    truncated = False
+    if not args.no_cache:
+        truncated = load_image_cache(cache_path)
+        if image_cache:
+            print(f"  🗂️  {len(image_cache)} cached article image lists")
 
+    with open(cache_path, "w" if args.no_cache else "a", encoding="utf-8") as cache_file:
+        if truncated:
+            cache_file.write("\n")
         with tqdm(total=len(missing), desc="  Searching Wikipedia", unit="mun") as pbar:
-            for future in as_completed(futures):
-                result = future.result()
+            for m, result in map_unordered(process_municipality, missing, MAX_WORKERS):
                 if result["found"]:
                     found.append(result)
                 else:
                     not_found.append(result)
                 pbar.update(1)
                 pbar.set_postfix(found=len(found), missing=len(not_found))
+    cache_file = None
 
     # Save Wikipedia results
     wiki_results_path = DATA_DIR / "wikipedia-flags.json"
-    with open(wiki_results_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    save_json(wiki_results_path, {"found": found, "not_found": not_found})
     print(f"\n  💾 Saved results to {wiki_results_path}")
 
     # Download found flags
@@ -231,37 +330,35 @@ def main():
     download_errors = []
     total_bytes = 0
 
-    for result in tqdm(found, desc="  Downloading flags", unit="file"):
-        ext = get_file_extension(result["flag_filename"])
-        dest = RAW_FLAGS_DIR / result["uf"] / f"{result['ibge_code']}-{result['name'].lower().replace(' ', '-')}{ext}"
-
+    jobs = []
+    for result in found:
+        dest = RAW_FLAGS_DIR / flag_path(result)
         if dest.exists() and dest.stat().st_size > 0:
             downloaded += 1
-            continue
+        else:
+            jobs.append((result, result["flag_url"], dest))
 
-        ok, size_or_error = download_file(result["flag_url"], dest)
+    for result, (ok, size_or_error) in tqdm(download_many(download_file, jobs, MAX_WORKERS, DOWNLOAD_DELAY),
+                                            total=len(jobs), desc="  Downloading flags", unit="file"):
         if ok:
             downloaded += 1
             total_bytes += size_or_error
         else:
             download_errors.append({**result, "error": size_or_error})
 
-        time.sleep(0.3)
-
     # Update main database
-    found_codes = {r["ibge_code"] for r in found}
+    found_by_code = {r["ibge_code"]: r for r in found}
     for m in municipios:
-        if m["ibge_code"] in found_codes:
-            result = next(r for r in found if r["ibge_code"] == m["ibge_code"])
+        result = found_by_code.get(m["ibge_code"])
+        if result:
             m["flag_status"] = "found"
             m["flag_source"] = "wikipedia"
             m["flag_url"] = result["flag_url"]
             m["flag_file"] = result["flag_filename"]
-            ext = get_file_extension(result["flag_filename"])
-            m["flag_local"] = f"raw-flags/{m['uf']}/{m['ibge_code']}-{m['name'].lower().replace(' ', '-')}{ext}"
+            if (RAW_FLAGS_DIR / flag_path(result)).exists():
+                m["flag_local"] = f"raw-flags/{flag_path(result)}"
 
-    with open(db_path, "w", encoding="utf-8") as f:
-        json.dump(municipios, f, ensure_ascii=False, indent=2)
+    save_municipios(db_path, municipios)
 
     # Summary
     still_missing = sum(1 for m in municipios if m["flag_status"] != "found")
@@ -6,16 +6,23 @@ For each missing municipality, searches its Wikipedia article for flag images.
 Uses strict matching to avoid state/national flags.
 """
 
+import functools
 import json
 import re
-import time
 import unicodedata
 import urllib.request
 import urllib.parse
 from pathlib import Path
 
+import http_session
+from brazil_states import STATE_SLUGS
+from downloader import TokenBucket, retry_after
+from municipios_db import save_json
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
+API_RATE = TokenBucket(rate=2, capacity=2)  # API requests per second, backed off on 429
+
 STATE_FLAGS = {
     "bandeira do acre", "bandeira de alagoas", "bandeira do amapá", "bandeira do amazonas",
     "bandeira da bahia", "bandeira do ceará", "bandeira do distrito federal",
@@ -28,50 +35,55 @@ STATE_FLAGS = {
     "bandeira do tocantins", "bandeira do brasil",
 }
 
-# State name slugs to exclude from filenames
-STATE_SLUGS = {
-    "acre", "alagoas", "amapa", "amazonas", "bahia", "ceara", "distrito-federal",
-    "espirito-santo", "goias", "maranhao", "mato-grosso", "mato-grosso-do-sul",
-    "minas-gerais", "para", "paraiba", "parana", "pernambuco", "piaui",
-    "rio-de-janeiro", "rio-grande-do-norte", "rio-grande-do-sul", "rondonia",
-    "roraima", "santa-catarina", "sao-paulo", "sergipe", "tocantins",
-}
-
 
+@functools.lru_cache(maxsize=None)
 def normalize(text):
+    if text.isascii():
+        # No accents to strip
+        return text.lower()
     text = unicodedata.normalize("NFD", text.lower())
     text = "".join(c for c in text if unicodedata.category(c) != "Mn")
     return text
 
 
+@functools.lru_cache(maxsize=None)
 def slugify(text):
     text = normalize(text)
     text = re.sub(r"[^a-z0-9]+", "-", text)
     return text.strip("-")
 
 
+# Precomputed once rather than for every image checked; one pass over the
+# filename instead of a substring test per state
+STATE_FLAGS_RE = re.compile("|".join(
+    re.escape(normalize(state_flag)) for state_flag in sorted(STATE_FLAGS)
+))
+STATE_FLAG_SLUGS = {
+    f"bandeira-{prep}-{state_slug}" for state_slug in STATE_SLUGS for prep in ("de", "do")
+}
+
+
 def is_likely_flag(filename, municipality_name, uf):
     """Check if filename looks like a municipality flag."""
     fn = normalize(filename)
-    mun = normalize(municipality_name)
-    mun_slug = slugify(municipality_name)
 
     # Must contain "bandeira" or "flag"
     if "bandeira" not in fn and "flag" not in fn:
         return False
 
+    mun = normalize(municipality_name)
+    mun_slug = slugify(municipality_name)
+    fn_slug = slugify(filename)
+
     # Reject state flags
-    for state_flag in STATE_FLAGS:
-        if normalize(state_flag) in fn:
-            # Unless municipality name is also in the filename
-            if mun_slug not in slugify(filename):
-                return False
+    if STATE_FLAGS_RE.search(fn):
+        # Unless municipality name is also in the filename
+        if mun_slug not in fn_slug:
+            return False
 
     # Reject if filename is just a state slug
-    fn_slug = slugify(filename)
-    for state_slug in STATE_SLUGS:
-        if fn_slug == f"bandeira-de-{state_slug}" or fn_slug == f"bandeira-do-{state_slug}":
-            return False
+    if fn_slug in STATE_FLAG_SLUGS:
+        return False
 
     # Must contain some part of the municipality name
     mun_words = [w for w in mun.split() if len(w) >= 3]
@@ -96,16 +108,20 @@ def search_wikipedia_flag(name, uf):
         url = f"https://pt.wikipedia.org/w/api.php?action=query&titles={encoded}&prop=images&imlimit=50&format=json"
         req = urllib.request.Request(url, headers={
             "User-Agent": "BandeirasmunicipiosBR/1.0 (https://github.com/nataliasm23/icones-bandeiras-br-uf) Python/3",
+            "Accept-Encoding": "gzip",
         })
         data = None
         for attempt in range(3):
+            API_RATE.acquire()
             try:
-                with urllib.request.urlopen(req, timeout=15) as resp:
-                    data = json.load(resp)
+                with http_session.urlopen(req, timeout=15) as resp:
+                    data = json.loads(http_session.read_body(resp))
+                API_RATE.success()
                 break
             except urllib.error.HTTPError as e:
                 if e.code == 429:
-                    time.sleep(10 * (attempt + 1))
+                    wait = retry_after(e.headers)
+                    API_RATE.pause(10 * (attempt + 1) if wait is None else wait)
                     continue
                 break
             except Exception:
@@ -154,12 +170,9 @@ def main():
         else:
             not_found.append(m)
 
-        time.sleep(1)  # Rate limit
-
     # Save results
     out_path = DATA_DIR / "wikipedia-targeted-flags.json"
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump({"found": found, "not_found": not_found}, f, ensure_ascii=False, indent=2)
+    save_json(out_path, {"found": found, "not_found": not_found})
 
     print(f"\n{'=' * 60}")
     print(f"  RESULTS")
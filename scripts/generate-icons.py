@@ -18,23 +18,56 @@ Output structure:
     square-rounded/png-800/{UF}/ 800x800 PNG
 
 Usage:
-  python3 scripts/generate-icons.py [--workers N] [--uf SP] [--skip-png] [--skip-svg]
+  python3 scripts/generate-icons.py [--workers N] [--uf SP] [--skip-png] [--skip-svg] [--force]
+                                    [--png-compress-level 0-9] [--png-encoder vips]
+                                    [--svg-link-png]
+
+Flags whose icons all exist, are newer than the source file and were
+made with the same --png-compress-level, --png-encoder and --svg-link-png
+settings (recorded per flag in data/icon-settings.json) are skipped; pass
+--force to regenerate them anyway (e.g. after changing the templates).
+
+PNGs are written with zlib level 1 by default, which encodes several times
+faster than Pillow's default of 6 for files ~15% larger. Pass
+--png-compress-level 6 (or 9) for release builds, or recompress the
+finished set with scripts/optimize-dist-pngs.py (zopfli).
+
+--png-encoder vips hands the PNG encoding to libvips (`pip install pyvips`,
+plus libvips itself or `pip install pyvips-binary`). Decoding, resizing
+and masking stay in Pillow, so the pixels are the same; libvips writes
+unfiltered PNGs, which encode several times faster than Pillow's
+adaptively filtered ones, so a higher level is affordable with it.
+
+SVGs embed their image as a base64 data URI so each file stands alone,
+which is what <img src="...svg"> needs: browsers do not load external
+resources from SVGs used as images. --svg-link-png instead points each
+SVG at its png-200 sibling, for SVGs inlined into HTML or served next to
+the PNGs; they shrink to a few hundred bytes.
 """
 
 import argparse
-import base64
+import binascii
+import functools
+import hashlib
 import io
 import json
+import math
 import os
 import subprocess
 import sys
-import tempfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 from PIL import Image, ImageDraw
 from tqdm import tqdm
 
+from municipios_db import save_json
+
+try:
+    import pyvips  # optional, only for --png-encoder vips
+except Exception:  # ImportError, or OSError/Exception when libvips is missing
+    pyvips = None
+
 # Allow very large images (some municipality flags are huge)
 Image.MAX_IMAGE_PIXELS = None
 
@@ -47,6 +80,9 @@ DATA_DIR = ROOT / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 DIST_DIR = ROOT / "dist"
 MUNICIPIOS_JSON = DATA_DIR / "municipios.json"
+# ibge_code -> settings its SVGs/PNGs were last written with; kept out of
+# dist/, which is published
+ICON_SETTINGS_JSON = DATA_DIR / "icon-settings.json"
 
 # ---------------------------------------------------------------------------
 # SVG Templates
@@ -54,28 +90,28 @@ MUNICIPIOS_JSON = DATA_DIR / "municipios.json"
 SVG_FULL = """\
 <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
      viewBox="0 0 300 200" width="300" height="200">
-  <image width="300" height="200" href="{data_uri}" preserveAspectRatio="xMidYMid slice"/>
+  <image width="300" height="200" href="{href}" preserveAspectRatio="xMidYMid slice"/>
 </svg>"""
 
 SVG_ROUNDED = """\
 <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
      viewBox="0 0 300 200" width="300" height="200">
   <defs><clipPath id="r"><rect width="300" height="200" rx="20"/></clipPath></defs>
-  <image width="300" height="200" href="{data_uri}" clip-path="url(#r)" preserveAspectRatio="xMidYMid slice"/>
+  <image width="300" height="200" href="{href}" clip-path="url(#r)" preserveAspectRatio="xMidYMid slice"/>
 </svg>"""
 
 SVG_CIRCLE = """\
 <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
      viewBox="0 0 200 200" width="200" height="200">
   <defs><clipPath id="c"><circle cx="100" cy="100" r="100"/></clipPath></defs>
-  <image width="200" height="200" href="{data_uri}" clip-path="url(#c)" preserveAspectRatio="xMidYMid slice"/>
+  <image width="200" height="200" href="{href}" clip-path="url(#c)" preserveAspectRatio="xMidYMid slice"/>
 </svg>"""
 
 SVG_SQUARE_ROUNDED = """\
 <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
      viewBox="0 0 200 200" width="200" height="200">
   <defs><clipPath id="sr"><rect width="200" height="200" rx="20"/></clipPath></defs>
-  <image width="200" height="200" href="{data_uri}" clip-path="url(#sr)" preserveAspectRatio="xMidYMid slice"/>
+  <image width="200" height="200" href="{href}" clip-path="url(#sr)" preserveAspectRatio="xMidYMid slice"/>
 </svg>"""
 
 
@@ -89,6 +125,13 @@ SVG_STYLES = {
     "square-rounded":  (SVG_SQUARE_ROUNDED,  200, 200, "sq"),
 }
 
+# Each template as UTF-8 bytes split around {href}, so the data URI (bytes)
+# is spliced in without a round trip through str
+SVG_TEMPLATE_PARTS = {
+    style_name: tuple(part.encode("utf-8") for part in template.split("{href}"))
+    for style_name, (template, w, h, suffix) in SVG_STYLES.items()
+}
+
 # PNG sizes: (size_label, scale_factor_from_base)
 # For 3:2 styles (full/rounded): base 300x200, large 1200x800
 # For 1:1 styles (circle/square-rounded): base 200x200, large 800x800
@@ -97,6 +140,9 @@ PNG_SIZES = {
     "png-800": 4,    # 4x scale
 }
 
+# zlib level for every PNG written (0-9); encoding dominates the run time
+PNG_COMPRESS_LEVEL = 1
+
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -115,59 +161,167 @@ def load_municipios(filter_uf=None):
     return result
 
 
-def svg_to_png(svg_path, output_path, width, height):
-    """Convert SVG to PNG using rsvg-convert."""
+def output_settings(compress_level, encoder, link_png):
+    """Options that change the bytes written, per output kind."""
+    png = {"compress_level": compress_level, "encoder": encoder}
+    # Linked SVGs don't contain a PNG, so the PNG options don't affect them
+    svg = {"link_png": True} if link_png else {"link_png": False, **png}
+    return {"svg": svg, "png": png}
+
+
+def load_icon_settings():
+    """Load the settings each flag's icons were last written with."""
+    try:
+        with open(ICON_SETTINGS_JSON, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def is_up_to_date(mun, settings, recorded, skip_svg=False, skip_png=False):
+    """True if every icon of mun that would be written exists, is newer than
+    its source and was written with the same settings."""
+    written_with = recorded.get(str(mun["ibge_code"]), {})
+    if not skip_svg and written_with.get("svg") != settings["svg"]:
+        return False
+    if not skip_png and written_with.get("png") != settings["png"]:
+        return False
     try:
-        subprocess.run(
+        source_mtime = (DATA_DIR / mun["flag_local"]).stat().st_mtime
+        for style_name, (_, _, _, suffix) in SVG_STYLES.items():
+            name = f"{mun['ibge_code']}-{mun['slug']}-{suffix}"
+            outputs = []
+            if not skip_svg:
+                outputs.append(DIST_DIR / style_name / "svg" / mun["uf"] / f"{name}.svg")
+            if not skip_png:
+                outputs += [DIST_DIR / style_name / size_label / mun["uf"] / f"{name}.png"
+                            for size_label in PNG_SIZES]
+            for out_path in outputs:
+                if out_path.stat().st_mtime < source_mtime:
+                    return False
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def group_by_source(municipios):
+    """Group municipalities whose flag files have identical content.
+
+    Some municipalities share a flag file byte for byte; each group is
+    rasterized once. Files that cannot be read get a group of their own,
+    so the usual error is reported for them.
+    """
+    groups = {}
+    for mun in municipios:
+        source_path = DATA_DIR / mun["flag_local"]
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            with open(source_path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+        except OSError:
+            key = ("unreadable", mun["ibge_code"])
+        else:
+            # .svg sources take a different path, so the suffix is part of the key
+            key = (source_path.suffix.lower(), digest.digest())
+        groups.setdefault(key, []).append(mun)
+    return list(groups.values())
+
+
+def raster_to_sized_images(source_path, sizes):
+    """Open any raster image and return {(width, height): resized RGBA Image}.
+
+    The source is decoded once for all sizes. Large JPEGs are decoded at a
+    reduced scale (libjpeg's DCT scaling via draft()), kept at least twice
+    the largest size so Lanczos still has enough samples.
+    """
+    with Image.open(source_path) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (2 * max(w for w, h in sizes), 2 * max(h for w, h in sizes)))
+        img = img.convert("RGBA")
+    return {(w, h): img.resize((w, h), Image.LANCZOS) for w, h in sizes}
+
+
+def svg_source_to_png_bytes(source_path, width, height):
+    """Convert SVG source to PNG bytes using rsvg-convert (None on failure).
+
+    The PNG is read from rsvg-convert's stdout instead of a temporary file.
+    """
+    try:
+        result = subprocess.run(
             [
                 "rsvg-convert",
                 "-w", str(width),
                 "-h", str(height),
                 "--keep-aspect-ratio",
-                "-o", str(output_path),
-                str(svg_path),
+                str(source_path),
             ],
             check=True,
             capture_output=True,
         )
-        return True
     except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+        return None
+    return result.stdout or None
 
 
-def raster_to_png_bytes(source_path, width, height):
-    """Open any raster image and return resized PNG bytes."""
-    with Image.open(source_path) as img:
-        img = img.convert("RGBA")
-        img = img.resize((width, height), Image.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return buf.getvalue()
+def svg_source_to_sized_images(source_path, sizes):
+    """Render an SVG source to an RGBA Image for every (width, height) in sizes.
+
+    rsvg-convert runs once per aspect ratio, at the largest size asked for;
+    the smaller sizes are Lanczos-downscaled from that render. Returns
+    {(width, height): Image}, or None if rsvg-convert failed.
+    """
+    images = {}
+    renders = {}  # reduced aspect ratio -> (width rendered at, Image)
+    for w, h in sorted(sizes, reverse=True):
+        g = math.gcd(w, h)
+        ratio = (w // g, h // g)
+        if ratio not in renders:
+            png = svg_source_to_png_bytes(source_path, w, h)
+            if png is None:
+                return None
+            img = Image.open(io.BytesIO(png)).convert("RGBA")
+            renders[ratio] = (w, img)
+            images[(w, h)] = img
+            continue
+        render_w, img = renders[ratio]
+        # rsvg-convert keeps the SVG's aspect ratio, so scale the render
+        # rather than stretching it to (w, h)
+        scale = w / render_w
+        images[(w, h)] = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    return images
+
+
+def encode_png(img, compress_level=PNG_COMPRESS_LEVEL, encoder="pillow"):
+    """Encode an RGBA Image as PNG bytes, with Pillow or libvips."""
+    if encoder == "vips":
+        vimg = pyvips.Image.new_from_memory(img.tobytes(), img.width, img.height, 4, "uchar")
+        return vimg.pngsave_buffer(compression=compress_level)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=compress_level)
+    return buf.getvalue()
 
 
-def svg_source_to_png_bytes(source_path, width, height):
-    """Convert SVG source to PNG bytes using rsvg-convert."""
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-        tmp_path = tmp.name
+# Output directories this worker process has already created; there are
+# only a few hundred of them (style x size x UF) across the whole run
+_made_dirs = set()
 
-    try:
-        success = svg_to_png(source_path, tmp_path, width, height)
-        if success and os.path.exists(tmp_path):
-            with open(tmp_path, "rb") as f:
-                return f.read()
-    finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
 
-    return None
+def ensure_dir(path):
+    """mkdir -p, skipped for directories this process already created."""
+    if path not in _made_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _made_dirs.add(path)
 
 
 def to_base64_data_uri(png_bytes):
-    """Convert PNG bytes to a base64 data URI."""
-    b64 = base64.b64encode(png_bytes).decode("ascii")
-    return f"data:image/png;base64,{b64}"
+    """Convert PNG bytes to a base64 data URI, as ASCII bytes."""
+    return b"data:image/png;base64," + binascii.b2a_base64(png_bytes, newline=False)
 
 
+# Masks depend only on the output size, so each is drawn once and shared
+# by every flag; callers must treat them as read-only.
+@functools.lru_cache(maxsize=32)
 def make_rounded_mask(size, radius):
     """Create a rounded rectangle alpha mask."""
     w, h = size
@@ -177,6 +331,7 @@ def make_rounded_mask(size, radius):
     return mask
 
 
+@functools.lru_cache(maxsize=32)
 def make_circle_mask(size):
     """Create a circular alpha mask."""
     w, h = size
@@ -186,72 +341,92 @@ def make_circle_mask(size):
     return mask
 
 
-def apply_mask(png_bytes, mask):
-    """Apply an alpha mask to PNG image bytes, return new PNG bytes."""
-    img = Image.open(io.BytesIO(png_bytes)).convert("RGBA")
-    # Resize mask to match image
-    if mask.size != img.size:
-        mask = mask.resize(img.size, Image.LANCZOS)
-    # Apply mask to alpha channel
-    r, g, b, a = img.split()
+def apply_mask(img, mask):
+    """Return a copy of an RGBA Image with mask (same size) as its alpha channel."""
+    img = img.copy()
     img.putalpha(mask)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
+    return img
 
 
 # ---------------------------------------------------------------------------
 # Main processing for a single municipality
 # ---------------------------------------------------------------------------
-def process_municipality(mun, skip_svg=False, skip_png=False):
+def process_municipality(mun, skip_svg=False, skip_png=False, compress_level=PNG_COMPRESS_LEVEL,
+                         link_png=False, same_source=(), png_encoder="pillow"):
     """Process a single municipality flag into all output formats.
 
-    Returns (ibge_code, success, error_msg)
-    """
-    ibge_code = mun["ibge_code"]
-    slug = mun["slug"]
-    uf = mun["uf"]
-    flag_local = mun["flag_local"]
+    same_source lists other municipalities whose flag file has the same
+    content; the source is rasterized once and their icons written from
+    that render too. With link_png, SVGs reference the png-200 PNG of the
+    same style instead of embedding the image.
 
-    source_path = DATA_DIR / flag_local
+    Returns a list of (ibge_code, success, error_msg, svg_count, png_count),
+    one per municipality; the counts are the files written.
+    """
+    muns = [mun, *same_source]
+    source_path = DATA_DIR / mun["flag_local"]
     if not source_path.exists():
-        return (ibge_code, False, f"Source file not found: {source_path}")
+        return [(m["ibge_code"], False, f"Source file not found: {source_path}", 0, 0) for m in muns]
 
     ext = source_path.suffix.lower()
     is_svg_source = ext == ".svg"
 
-    # Step 1: Normalize source to two PNG buffers (3:2 and 1:1)
+    # Step 1: Rasterize the source once per output size: 3:2 and 1:1 at
+    # base resolution, plus their 4x versions when PNGs are wanted
+    sizes = [(300, 200), (200, 200)]
+    if not skip_png:
+        sizes += [(1200, 800), (800, 800)]
+    # Images stay decoded until they are written; PNG encoding happens once
+    # per output file
     try:
+        sized_images = None
         if is_svg_source:
-            png_full_bytes = svg_source_to_png_bytes(source_path, 300, 200)
-            png_square_bytes = svg_source_to_png_bytes(source_path, 200, 200)
-            if not png_full_bytes or not png_square_bytes:
-                # Fallback: try opening as raster (some .svg are actually raster)
-                png_full_bytes = raster_to_png_bytes(source_path, 300, 200)
-                png_square_bytes = raster_to_png_bytes(source_path, 200, 200)
-        else:
-            png_full_bytes = raster_to_png_bytes(source_path, 300, 200)
-            png_square_bytes = raster_to_png_bytes(source_path, 200, 200)
+            sized_images = svg_source_to_sized_images(source_path, sizes)
+        if sized_images is None:
+            # Raster source, or an .svg rsvg-convert could not render
+            # (some .svg are actually raster)
+            sized_images = raster_to_sized_images(source_path, sizes)
     except Exception as e:
-        return (ibge_code, False, f"Failed to normalize: {e}")
+        return [(m["ibge_code"], False, f"Failed to normalize: {e}", 0, 0) for m in muns]
+
+    return [
+        write_outputs(m, sized_images, skip_svg, skip_png, compress_level, link_png, png_encoder)
+        for m in muns
+    ]
+
+
+def write_outputs(mun, sized_images, skip_svg, skip_png, compress_level, link_png, png_encoder):
+    """Write one municipality's SVG and PNG icons from the rasterized source.
+
+    Returns (ibge_code, success, error_msg, svg_count, png_count)
+    """
+    ibge_code = mun["ibge_code"]
+    slug = mun["slug"]
+    uf = mun["uf"]
+    svg_count = png_count = 0
 
     # Step 2: Generate base64 data URIs
-    data_uri_full = to_base64_data_uri(png_full_bytes)
-    data_uri_square = to_base64_data_uri(png_square_bytes)
+    if not skip_svg and not link_png:
+        data_uri_full = to_base64_data_uri(encode_png(sized_images[(300, 200)], compress_level, png_encoder))
+        data_uri_square = to_base64_data_uri(encode_png(sized_images[(200, 200)], compress_level, png_encoder))
 
     # Step 3: Generate SVG files
     if not skip_svg:
-        for style_name, (template, w, h, suffix) in SVG_STYLES.items():
+        for style_name, (_, w, h, suffix) in SVG_STYLES.items():
             out_dir = DIST_DIR / style_name / "svg" / uf
-            out_dir.mkdir(parents=True, exist_ok=True)
+            ensure_dir(out_dir)
 
             filename = f"{ibge_code}-{slug}-{suffix}.svg"
             out_path = out_dir / filename
 
-            data_uri = data_uri_full if w == 300 else data_uri_square
-            svg_content = template.format(data_uri=data_uri)
+            if link_png:
+                href = f"../../png-200/{uf}/{ibge_code}-{slug}-{suffix}.png".encode("utf-8")
+            else:
+                href = data_uri_full if w == 300 else data_uri_square
+            head, tail = SVG_TEMPLATE_PARTS[style_name]
 
-            out_path.write_text(svg_content, encoding="utf-8")
+            out_path.write_bytes(head + href + tail)
+            svg_count += 1
 
     # Step 4: Generate PNG files
     if not skip_png:
@@ -292,36 +467,34 @@ def process_municipality(mun, skip_svg=False, skip_png=False):
 
             for size_label, (w, h, mask_type) in sizes.items():
                 out_dir = DIST_DIR / style_name / size_label / uf
-                out_dir.mkdir(parents=True, exist_ok=True)
+                ensure_dir(out_dir)
 
                 filename = f"{ibge_code}-{slug}-{suffix}.png"
                 out_path = out_dir / filename
 
-                # Generate the sized PNG
                 try:
-                    if is_svg_source:
-                        sized_bytes = svg_source_to_png_bytes(source_path, w, h)
-                        if not sized_bytes:
-                            sized_bytes = raster_to_png_bytes(source_path, w, h)
-                    else:
-                        sized_bytes = raster_to_png_bytes(source_path, w, h)
+                    sized_img = sized_images[(w, h)]
 
-                    # Apply mask if needed
+                    # Apply mask if needed. Masks are drawn at the image's
+                    # actual size: an SVG render keeps its own aspect ratio
+                    # and can come out narrower than (w, h)
                     if mask_type == "rounded":
                         # Scale radius proportionally
                         base_size = 200 if w == h else 300
                         radius = int(20 * w / base_size)
-                        mask = make_rounded_mask((w, h), radius)
-                        sized_bytes = apply_mask(sized_bytes, mask)
+                        mask = make_rounded_mask(sized_img.size, radius)
+                        sized_img = apply_mask(sized_img, mask)
                     elif mask_type == "circle":
-                        mask = make_circle_mask((w, h))
-                        sized_bytes = apply_mask(sized_bytes, mask)
+                        mask = make_circle_mask(sized_img.size)
+                        sized_img = apply_mask(sized_img, mask)
 
-                    out_path.write_bytes(sized_bytes)
+                    out_path.write_bytes(encode_png(sized_img, compress_level, png_encoder))
+                    png_count += 1
                 except Exception as e:
-                    return (ibge_code, False, f"PNG generation failed ({style_name}/{size_label}): {e}")
+                    return (ibge_code, False, f"PNG generation failed ({style_name}/{size_label}): {e}",
+                            svg_count, png_count)
 
-    return (ibge_code, True, None)
+    return (ibge_code, True, None, svg_count, png_count)
 
 
 # ---------------------------------------------------------------------------
@@ -332,8 +505,8 @@ def main():
         description="Generate municipality flag icon set"
     )
     parser.add_argument(
-        "--workers", type=int, default=4,
-        help="Number of parallel workers (default: 4)"
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="Number of worker processes (default: all CPUs)"
     )
     parser.add_argument(
         "--uf", type=str, default=None,
@@ -347,11 +520,33 @@ def main():
         "--skip-svg", action="store_true",
         help="Skip SVG generation (PNG only)"
     )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Regenerate icons even when they are newer than their source"
+    )
     parser.add_argument(
         "--limit", type=int, default=0,
         help="Process only first N municipalities (for testing)"
     )
+    parser.add_argument(
+        "--png-compress-level", type=int, default=PNG_COMPRESS_LEVEL, choices=range(10),
+        metavar="0-9",
+        help=f"zlib level for PNG output; 6-9 for smaller release files (default: {PNG_COMPRESS_LEVEL})"
+    )
+    parser.add_argument(
+        "--png-encoder", choices=("pillow", "vips"), default="pillow",
+        help="Library that encodes the PNGs; vips is faster but needs pyvips (default: pillow)"
+    )
+    parser.add_argument(
+        "--svg-link-png", action="store_true",
+        help="Reference the png-200 files from the SVGs instead of embedding them "
+             "(smaller, but the SVGs no longer work on their own in <img>)"
+    )
     args = parser.parse_args()
+    if args.svg_link_png and args.skip_png:
+        parser.error("--svg-link-png needs the PNGs; drop --skip-png")
+    if args.png_encoder == "vips" and pyvips is None:
+        parser.error("--png-encoder vips needs pyvips and libvips (pip install pyvips pyvips-binary)")
 
     print(f"Loading municipality data from {MUNICIPIOS_JSON}...")
     municipios = load_municipios(filter_uf=args.uf)
@@ -359,44 +554,80 @@ def main():
     if args.limit > 0:
         municipios = municipios[:args.limit]
 
+    settings = output_settings(args.png_compress_level, args.png_encoder, args.svg_link_png)
+    recorded = load_icon_settings()
+    written = [kind for kind, skipped in (("svg", args.skip_svg), ("png", args.skip_png)) if not skipped]
+
+    up_to_date = 0
+    if not args.force:
+        stale = [m for m in municipios
+                 if not is_up_to_date(m, settings, recorded, args.skip_svg, args.skip_png)]
+        up_to_date = len(municipios) - len(stale)
+        municipios = stale
+
     total = len(municipios)
     print(f"Processing {total} municipalities with flags...")
+    if up_to_date:
+        print(f"  Up to date: {up_to_date} (skipped; --force regenerates them)")
 
     if args.skip_svg:
         print("  SVG generation: SKIPPED")
     else:
         print("  SVG generation: 4 styles (full, rounded, circle, square-rounded)")
+        if args.svg_link_png:
+            print("  SVG images: linked to png-200 files")
 
     if args.skip_png:
         print("  PNG generation: SKIPPED")
     else:
         print("  PNG generation: 4 styles x 2 sizes = 8 variants")
+        print(f"  PNG compression level: {args.png_compress_level} ({args.png_encoder})")
 
     print(f"  Workers: {args.workers}")
     print(f"  Output: {DIST_DIR}")
+
+    groups = group_by_source(municipios)
+    if len(groups) < total:
+        print(f"  Shared flag files: {total - len(groups)} flags reuse another's render")
     print()
 
     successes = 0
     failures = []
+    svg_count = png_count = 0
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    # Processes rather than threads: resizing, masking and PNG encoding are
+    # CPU-bound, and only part of that work runs outside the GIL
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
         futures = {
             executor.submit(
-                process_municipality, mun,
+                process_municipality, group[0],
                 skip_svg=args.skip_svg,
                 skip_png=args.skip_png,
-            ): mun
-            for mun in municipios
+                compress_level=args.png_compress_level,
+                link_png=args.svg_link_png,
+                same_source=group[1:],
+                png_encoder=args.png_encoder,
+            ): group
+            for group in groups
         }
 
         with tqdm(total=total, desc="Generating icons", unit="flag") as pbar:
             for future in as_completed(futures):
-                ibge_code, success, error_msg = future.result()
-                if success:
-                    successes += 1
-                else:
-                    failures.append((ibge_code, error_msg))
-                pbar.update(1)
+                for ibge_code, success, error_msg, svgs, pngs in future.result():
+                    svg_count += svgs
+                    png_count += pngs
+                    if success:
+                        successes += 1
+                        recorded.setdefault(str(ibge_code), {}).update(
+                            (kind, settings[kind]) for kind in written)
+                    else:
+                        failures.append((ibge_code, error_msg))
+                        for kind in written:  # may be half written
+                            recorded.get(str(ibge_code), {}).pop(kind, None)
+                    pbar.update(1)
+
+    if total:
+        save_json(ICON_SETTINGS_JSON, recorded)
 
     # Summary
     print()
@@ -409,16 +640,12 @@ def main():
         if len(failures) > 20:
             print(f"  ... and {len(failures) - 20} more")
 
-    # Count output files
     if not args.skip_svg:
-        svg_count = sum(1 for _ in DIST_DIR.rglob("*.svg")
-                       if any(p.name in [str(m["uf"]) for m in municipios]
-                              for p in _.parents))
-        print(f"\nSVG files generated: ~{svg_count}")
+        print(f"\nSVG files generated: {svg_count}")
 
     if not args.skip_png:
-        png_count = sum(1 for _ in DIST_DIR.rglob("*.png"))
-        print(f"PNG files generated: ~{png_count}")
+        print(f"PNG files generated: {png_count}")
+        print("For release, shrink them with: python3 scripts/optimize-dist-pngs.py")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+"""
+Keep-alive HTTP(S) shared by the flag collection scripts.
+
+urllib.request.urlopen opens a new TCP + TLS connection for every request.
+urlopen() here is a drop-in replacement that keeps one persistent connection
+per host in each thread, so the thousands of requests the scripts send to
+upload.wikimedia.org, commons.wikimedia.org, etc. reuse it instead of paying
+a handshake each time.
+
+Usage (from a script in this directory):
+  import http_session
+  req = urllib.request.Request(url, headers={"User-Agent": ...})
+  with http_session.urlopen(req, timeout=30) as response:
+      data = response.read()
+
+Each thread keeps at most MAX_HOSTS connections open; the least recently
+used one is closed when a new host is contacted, so crawling many
+different sites does not pile up idle sockets.
+
+Like urllib, redirects are followed and 4xx/5xx statuses raise
+urllib.error.HTTPError. Read responses to the end so the connection can be
+reused; a response that is closed (or left) before its body ends makes the
+next request to that host open a fresh connection.
+
+API calls can send "Accept-Encoding: gzip" and read the body with
+read_body(), which undoes the compression; the result can go straight to
+json.loads(), which accepts UTF-8 bytes. File downloads should not ask for
+gzip, since images are already compressed.
+"""
+
+import gzip
+import http.client
+import io
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+MAX_REDIRECTS = 5
+MAX_HOSTS = 8  # open connections kept per thread
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+_local = threading.local()
+
+
+class _Response(http.client.HTTPResponse):
+    """HTTPResponse that remembers being closed before its body ended.
+
+    isclosed() is true both after the body was read to EOF and after an
+    early close(), but only in the first case is the socket positioned at
+    the next response.
+    """
+
+    abandoned = False
+
+    def close(self):
+        if self.fp is not None:
+            self.abandoned = True
+        super().close()
+
+
+def _connections() -> dict:
+    """Per-thread map of (scheme, host) -> [connection, last response], oldest first."""
+    conns = getattr(_local, "connections", None)
+    if conns is None:
+        conns = _local.connections = {}
+    return conns
+
+
+def _get_connection(scheme: str, netloc: str, timeout: float) -> tuple:
+    """Return (connection, reused) for a host, opening one if needed."""
+    key = (scheme, netloc)
+    conns = _connections()
+    slot = conns.get(key)
+
+    if slot is not None:
+        conn, last_response = slot
+        conns[key] = conns.pop(key)  # mark as most recently used
+        if last_response is None or (last_response.isclosed() and not last_response.abandoned):
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        # Previous body was not read to the end; unread bytes are still on
+        # the socket, so it can't be reused
+        conn.close()
+    elif len(conns) >= MAX_HOSTS:
+        _drop_connection(*next(iter(conns)))
+
+    if scheme == "https":
+        conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(netloc, timeout=timeout)
+    conn.response_class = _Response
+    conns[key] = [conn, None]
+    return conn, False
+
+
+def _drop_connection(scheme: str, netloc: str):
+    slot = _connections().pop((scheme, netloc), None)
+    if slot is not None:
+        slot[0].close()
+
+
+def _send(method: str, url: str, headers: dict, data, timeout: float):
+    """Send one request over the pooled connection and return the response."""
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    for attempt in range(2):
+        conn, reused = _get_connection(parts.scheme, parts.netloc, timeout)
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            _drop_connection(parts.scheme, parts.netloc)
+            # The server may have closed an idle keep-alive connection;
+            # retry once on a fresh one
+            if reused and attempt == 0:
+                continue
+            raise
+        except OSError:
+            _drop_connection(parts.scheme, parts.netloc)
+            raise
+        _connections()[(parts.scheme, parts.netloc)][1] = response
+        return response
+
+
+def urlopen(req, timeout: float = 30):
+    """Open a URL (str or urllib.request.Request) over a kept-alive connection."""
+    if isinstance(req, str):
+        req = urllib.request.Request(req)
+
+    url = req.full_url
+    method = req.get_method()
+    data = req.data
+    headers = dict(req.header_items())
+
+    for _ in range(MAX_REDIRECTS + 1):
+        response = _send(method, url, headers, data, timeout)
+
+        location = response.getheader("Location")
+        if response.status in REDIRECT_CODES and location:
+            response.read()  # drain so the connection stays usable
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == "POST"):
+                method, data = "GET", None
+            continue
+
+        if response.status >= 400:
+            body = response.read()
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers, io.BytesIO(body)
+            )
+
+        response.url = url
+        return response
+
+    response.read()
+    raise urllib.error.HTTPError(
+        url, response.status, "Too many redirects", response.headers, io.BytesIO(b"")
+    )
+
+
+def read_body(response) -> bytes:
+    """Read a whole response body, decompressing it if it was sent gzipped."""
+    body = response.read()
+    if response.getheader("Content-Encoding", "").lower() == "gzip":
+        body = gzip.decompress(body)
+    return body
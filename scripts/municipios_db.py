@@ -0,0 +1,56 @@
+"""
+Read/write helpers for data/municipios.json and the other data/*.json files
+shared by the flag scripts.
+
+Files are written to a temporary name and renamed into place, so a run
+interrupted mid-write leaves the previous version intact instead of a
+truncated file that the next run fails to load.
+
+Usage (from a script in this directory):
+  from municipios_db import save_json, save_municipios
+  save_municipios(db_path, municipios)
+  save_json(out_path, {"found": found, "not_found": not_found})
+"""
+
+import json
+import os
+from pathlib import Path
+
+
+def write_json_array(f, items):
+    """Write a list as indent=2 JSON, one element at a time.
+
+    Produces the same text as json.dumps(items, ensure_ascii=False, indent=2)
+    without materializing the whole document as one string.
+    """
+    if not items:
+        f.write("[]")
+        return
+    f.write("[\n")
+    for i, item in enumerate(items):
+        if i:
+            f.write(",\n")
+        f.write("  " + json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+    f.write("\n]")
+
+
+def _write_atomically(path: Path, write):
+    """Call write(f) on a temporary file and rename it over path when done."""
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def save_json(path: Path, data):
+    """Write any JSON document as indent=2 with non-ASCII kept as-is."""
+    _write_atomically(path, lambda f: json.dump(data, f, ensure_ascii=False, indent=2))
+
+
+def save_municipios(path: Path, municipios: list):
+    """Write the municipality database in the repo's indent=2 JSON format."""
+    _write_atomically(path, lambda f: write_json_array(f, municipios))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Recompress the generated PNG icons with zopflipng before a release.
+
+generate-icons.py writes PNGs with fast zlib settings so that regenerating
+the set stays quick. This lossless post-pass squeezes the finished files in
+dist/ with zopfli, which is far too slow to run for every icon while
+generating but takes a few percent more off each file. Files are only
+replaced when zopflipng makes them smaller.
+
+Requires zopflipng (`brew install zopfli` on macOS, `apt install zopfli`).
+
+Usage:
+  python3 scripts/optimize-dist-pngs.py [--workers N] [--uf SP] [--dir dist/circle]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+ROOT = Path(__file__).resolve().parent.parent
+DIST_DIR = ROOT / "dist"
+
+
+def optimize_png(path):
+    """Run zopflipng on one file in place.
+
+    Returns (path, size_before, size_after, error_msg).
+    """
+    before = path.stat().st_size
+    try:
+        subprocess.run(
+            ["zopflipng", "-m", "-y", str(path), str(path)],
+            check=True,
+            capture_output=True,
+        )
+    except subprocess.CalledProcessError as e:
+        return (path, before, before, e.stderr.decode("utf-8", "replace").strip())
+    return (path, before, path.stat().st_size, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Losslessly recompress dist/ PNGs with zopflipng"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="Number of zopflipng processes run at once (default: all CPUs)"
+    )
+    parser.add_argument(
+        "--uf", type=str, default=None,
+        help="Optimize only a specific UF (e.g., SP)"
+    )
+    parser.add_argument(
+        "--dir", type=Path, default=DIST_DIR,
+        help=f"Directory searched for PNGs (default: {DIST_DIR})"
+    )
+    args = parser.parse_args()
+
+    if shutil.which("zopflipng") is None:
+        sys.exit("zopflipng not found; install zopfli first")
+
+    pngs = sorted(args.dir.rglob("*.png"))
+    if args.uf:
+        pngs = [p for p in pngs if p.parent.name == args.uf.upper()]
+
+    print(f"Optimizing {len(pngs)} PNGs in {args.dir} with {args.workers} workers...")
+
+    total_before = total_after = 0
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(optimize_png, p) for p in pngs]
+        with tqdm(total=len(pngs), desc="Optimizing PNGs", unit="file") as pbar:
+            for future in as_completed(futures):
+                path, before, after, error_msg = future.result()
+                total_before += before
+                total_after += after
+                if error_msg:
+                    failures.append((path, error_msg))
+                pbar.update(1)
+
+    saved = total_before - total_after
+    pct = (saved / total_before * 100) if total_before else 0
+    print()
+    print(f"Done! {total_before / 1e6:.1f} MB -> {total_after / 1e6:.1f} MB "
+          f"({saved / 1e6:.1f} MB, {pct:.1f}% saved)")
+
+    if failures:
+        print(f"\n{len(failures)} failures:")
+        for path, msg in failures[:20]:
+            print(f"  {path}: {msg}")
+        if len(failures) > 20:
+            print(f"  ... and {len(failures) - 20} more")
+
+
+if __name__ == "__main__":
+    main()
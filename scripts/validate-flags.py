@@ -10,11 +10,13 @@ Checks:
 5. Not an HTML error page
 """
 
-import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 
+from municipios_db import save_json
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 RAW_FLAGS_DIR = DATA_DIR / "raw-flags"
 
@@ -42,6 +44,8 @@ HTML_ERROR_INDICATORS = [
     b"Error",
     b"<head>",
 ]
+# Lowercased up front for the case-insensitive header check
+HTML_ERROR_INDICATORS_LOWER = [(i, i.lower()) for i in HTML_ERROR_INDICATORS]
 
 
 def validate_file(filepath: Path) -> dict:
@@ -63,12 +67,14 @@ def validate_file(filepath: Path) -> dict:
 
     # Check for HTML error pages masquerading as images
     if ext != ".svg":  # SVG can contain XML/HTML-like content
-        for indicator in HTML_ERROR_INDICATORS:
-            if indicator.lower() in header.lower():
+        header_lower = header.lower()
+        for indicator, indicator_lower in HTML_ERROR_INDICATORS_LOWER:
+            if indicator_lower in header_lower:
                 issues.append(f"Appears to be HTML, not an image ({indicator.decode('utf-8', errors='ignore')[:30]})")
                 break
 
     # Magic bytes check
+    magic_match = True
     if ext in MAGIC_BYTES:
         magic_match = False
         for magic in MAGIC_BYTES[ext]:
@@ -85,8 +91,9 @@ def validate_file(filepath: Path) -> dict:
                 actual = header[:20].hex()
                 issues.append(f"Bad magic bytes for {ext}: {actual}")
 
-    # SVG-specific checks
-    if ext == ".svg":
+    # SVG-specific checks (pointless to read the whole file when the header
+    # already showed it is not SVG)
+    if ext == ".svg" and magic_match:
         try:
             full_content = filepath.read_text(encoding="utf-8", errors="ignore")
             if "<svg" not in full_content.lower():
@@ -127,8 +134,13 @@ def main():
     ext_counts = {}
     ext_sizes = {}
 
-    for filepath in tqdm(all_files, desc="  Validating", unit="file"):
-        result = validate_file(filepath)
+    # Files are independent, so spread them over all CPUs; chunks keep the
+    # per-file IPC overhead down, and map() keeps the results in path order
+    with ProcessPoolExecutor() as executor:
+        results = list(tqdm(executor.map(validate_file, all_files, chunksize=64),
+                            total=len(all_files), desc="  Validating", unit="file"))
+
+    for result in results:
         ext = result["ext"]
         ext_counts[ext] = ext_counts.get(ext, 0) + 1
         ext_sizes[ext] = ext_sizes.get(ext, 0) + result["size"]
@@ -161,8 +173,7 @@ def main():
 
         # Save full invalid list
         invalid_path = DATA_DIR / "invalid-flags.json"
-        with open(invalid_path, "w", encoding="utf-8") as f:
-            json.dump(invalid_files, f, ensure_ascii=False, indent=2)
+        save_json(invalid_path, invalid_files)
         print(f"\n  💾 Full invalid list saved to {invalid_path}")
 
         # Cleanup option
@@ -170,7 +181,7 @@ def main():
         print(f"\n  Invalid files total size: {total_invalid_size / 1024:.1f} KB")
         print(f"  To clean up: delete files listed in data/invalid-flags.json")
 
-    total_size = sum(f.stat().st_size for f in all_files)
+    total_size = sum(ext_sizes.values())
     print(f"\n  Total collection size: {total_size / (1024*1024):.1f} MB")
     print("=" * 60)
 